@@ -0,0 +1,247 @@
+import logging
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from rules.Mancala import Board, SOWING_TABLE
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+# Finished games score beyond any home difference, keeping the margin so
+# bigger wins are preferred
+WIN_SCORE = 1000
+
+# Transposition table entry flags
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class AlphaBeta:
+    """ Negamax search with alpha-beta pruning over Board.
+
+    Iterative deepening runs deeper searches until max_depth is reached or
+    time_limit seconds have passed and returns the best move of the last
+    finished depth. Values are from the point of view of the player to
+    move. A move that ends in the player's own home keeps the turn, so the
+    value of that child is not negated and the window is not swapped.
+
+    Moves are tried best move from the transposition table first, then
+    extra turns, captures and the rest. The transposition table is keyed
+    by the Zobrist hash and cleared once it holds max_entries positions.
+    Positions in the endgame tablebase, if given, are scored exactly. """
+
+    def __init__(self, max_depth=64, time_limit=1.0, max_entries=1 << 20,
+                 tablebase=None):
+        self.max_depth = max_depth
+        self.time_limit = time_limit
+        self.max_entries = max_entries
+        self.tablebase = tablebase
+        self.table = {}
+        self.nodes = 0
+        self.deadline = None
+
+    def think(self, board):
+        """ Best move for the player to move """
+        return self.search(board)[0]
+
+    def search(self, board):
+        """ (best move, value, depth) of the deepest finished search. A
+            forced move is returned at once with value 0 and depth 0 """
+        start = time.time()
+        self.deadline = start + self.time_limit \
+            if self.time_limit is not None else None
+        self.nodes = 0
+        legal_moves = board.get_legal_moves()
+        best_move, best_value, depth_done = legal_moves[0], 0, 0
+        if len(legal_moves) == 1:
+            return best_move, best_value, depth_done
+        solved = self.tablebase.probe(board) \
+            if self.tablebase is not None else None
+        if solved is not None:
+            return solved[1], solved[0] * WIN_SCORE, depth_done
+
+        for depth in range(1, self.max_depth + 1):
+            try:
+                value = self.negamax(board, depth, -float("inf"),
+                                     float("inf"))
+            except SearchTimeout:
+                break
+            best_move = self.table[board.zobrist][3]
+            best_value, depth_done = value, depth
+            # A decided game does not get any better with more depth
+            if abs(value) >= WIN_SCORE:
+                break
+        logger.debug("Depth %d, value %d, %d nodes in %.2f sec"
+                     % (depth_done, best_value, self.nodes,
+                        time.time() - start))
+        return best_move, best_value, depth_done
+
+    def negamax(self, board, depth, alpha, beta):
+        self.nodes += 1
+        if self.deadline is not None and self.nodes % 1024 == 0 \
+                and time.time() > self.deadline:
+            raise SearchTimeout()
+
+        if board.game_over:
+            return self.final_score(board)
+        if self.tablebase is not None:
+            solved = self.tablebase.probe(board)
+            if solved is not None:
+                return solved[0] * WIN_SCORE
+        if depth == 0:
+            return self.evaluate(board)
+
+        alpha_orig = alpha
+        entry = self.table.get(board.zobrist)
+        hash_move = None
+        if entry is not None:
+            entry_depth, value, flag, hash_move = entry
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return value
+                if flag == LOWER:
+                    alpha = max(alpha, value)
+                elif flag == UPPER:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        best_value, best_move = -float("inf"), None
+        player = board.player
+        for move in self.ordered_moves(board, hash_move):
+            child = board.clone()
+            child.process_move(move)
+            # The turn does not pass on an extra turn, nor when the game
+            # ends, final_score is then for the player who just moved
+            if child.player == player:
+                # Extra turn: same player, same window, same sign
+                value = self.negamax(child, depth - 1, alpha, beta)
+            else:
+                value = -self.negamax(child, depth - 1, -beta, -alpha)
+            if value > best_value:
+                best_value, best_move = value, move
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best_value <= alpha_orig:
+            flag = UPPER
+        elif best_value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        if len(self.table) >= self.max_entries:
+            self.table.clear()
+        self.table[board.zobrist] = (depth, best_value, flag, best_move)
+        return best_value
+
+    @staticmethod
+    def final_score(board):
+        """ Score of a finished game for board.player, the last mover """
+        margin = board.current_board[6] - board.current_board[13]
+        if not board.is_player_1s_turn:
+            margin = -margin
+        if margin > 0:
+            return WIN_SCORE + margin
+        if margin < 0:
+            return margin - WIN_SCORE
+        return 0
+
+    @staticmethod
+    def evaluate(board):
+        """ Home difference for the player to move """
+        margin = board.current_board[6] - board.current_board[13]
+        return margin if board.is_player_1s_turn else -margin
+
+    @staticmethod
+    def ordered_moves(board, hash_move=None):
+        """ Legal moves, best first: the hash move, extra turns, captures
+            by size and then the others from the home outwards """
+        current = board.current_board
+        player = board.player
+        own_home = 6 if player == 1 else 13
+        scored = []
+        for move in board.legal_moves:
+            marbles = current[move]
+            landing = SOWING_TABLE[player][move][marbles][0]
+            # A full lap of 13 lands back in the emptied starting pit
+            lands_empty = marbles == 13 or \
+                (marbles < 13 and current[landing] == 0)
+            if move == hash_move:
+                score = 1000
+            elif landing == own_home:
+                score = 500 + move
+            elif lands_empty and board.own_side_pit(landing) and \
+                    current[12 - landing] > 0:
+                score = 100 + current[12 - landing]
+            else:
+                score = move
+            scored.append((score, move))
+        scored.sort(reverse=True)
+        return [move for _, move in scored]
+
+
+def random_move(board):
+    return np.random.choice(board.get_legal_moves())
+
+
+def play_game(first, second):
+    """ Play a game between two players, functions from a Board to a
+        move. Returns the winner as from Board.get_winner """
+    board = Board()
+    while not board.game_over:
+        player = first if board.player == 1 else second
+        board.process_move(player(board))
+    return board.get_winner()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--games", type=int, default=10,
+                        help="Nbr of games to play against the opponent")
+    parser.add_argument("--time_limit", type=float, default=0.5,
+                        help="Seconds per alpha-beta move")
+    parser.add_argument("--model", default=None,
+                        help="Net checkpoint in model_data to play, "
+                             "a random player if not given")
+    parser.add_argument("--search_depth", type=int, default=300,
+                        help="Simulations per move of the net's search")
+    args = parser.parse_args()
+
+    engine = AlphaBeta(time_limit=args.time_limit)
+    if args.model is not None:
+        import os
+        import torch
+        from NeuralNet import JasonNet
+        from MonteCarlo import search, get_policy
+
+        net = JasonNet()
+        net.load_state_dict(torch.load(os.path.join("./model_data/",
+                                                    args.model)))
+        net.eval()
+
+        def opponent(board):
+            with torch.no_grad():
+                root = search(board, args.search_depth, net)
+            policy = get_policy(root, 0.1)
+            legal_moves = board.get_legal_moves()
+            return legal_moves[int(np.argmax(
+                [policy[move] for move in legal_moves]))]
+    else:
+        opponent = random_move
+
+    score = 0
+    for game in range(args.games):
+        # Alternate who goes first
+        if game % 2 == 0:
+            score += play_game(engine.think, opponent)
+        else:
+            score -= play_game(opponent, engine.think)
+    logger.info("Alpha-beta score against %s: %+d over %d games"
+                % (args.model or "random", score, args.games))
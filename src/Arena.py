@@ -1,44 +1,140 @@
 import logging
-import torch
+import math
 import numpy as np
-from tqdm import tqdm
 from rules.Mancala import Board
-from MonteCarlo import search, get_policy
+from MonteCarlo import get_policy, tree_search
+from EvalCache import EvalCache
+from LazyImport import LazyModule, tqdm
+
+torch = LazyModule("torch")
+mp = LazyModule("torch.multiprocessing")
 
 logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 logger = logging.getLogger(__file__)
 
 
+WINNING_RATIO = 0.55
+
+
+class SequentialTest:
+    """ Sequential probability ratio test of the new net's score.
+
+    Tests H0: score = threshold - margin against H1: score = threshold +
+    margin, counting a draw as half a win. After every game the log
+    likelihood ratio is compared with the Wald bounds; crossing the upper
+    one accepts H1 (promote), the lower one accepts H0 (keep the best
+    net). alpha and beta are the error rates of the two decisions. """
+
+    def __init__(self, threshold=WINNING_RATIO, margin=0.1, alpha=0.05,
+                 beta=0.05):
+        p0, p1 = threshold - margin, threshold + margin
+        self.win_llr = math.log(p1 / p0)
+        self.loss_llr = math.log((1 - p1) / (1 - p0))
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.llr = 0.0
+        self.games = 0
+        self.score = 0.0
+
+    def update(self, winner):
+        """ Add the result of one game, winner is "new", "best" or None """
+        result = {"new": 1.0, "best": 0.0}.get(winner, 0.5)
+        self.games += 1
+        self.score += result
+        self.llr += result * self.win_llr + (1 - result) * self.loss_llr
+
+    def decision(self):
+        """ True to promote, False to keep the best net, None if the test
+            has not reached either bound yet """
+        if self.llr >= self.upper:
+            return True
+        if self.llr <= self.lower:
+            return False
+        return None
+
+    def confidence(self):
+        """ Probability of the favoured hypothesis given equal priors """
+        return 1 / (1 + math.exp(-abs(self.llr)))
+
+
 class Arena:
-    def __init__(self, best_net, new_net):
+    def __init__(self, best_net, new_net, tablebase=None, flat_tree=False):
         logger.debug("Setup arena")
         self.best_net = best_net
         self.new_net = new_net
+        # Endgames it covers are searched and played perfectly by both
+        self.tablebase = tablebase
+        self.flat_tree = flat_tree
 
-    def battle(self, episodes, search_depth):
+    def battle(self, episodes, search_depth, batch_size=1, cache=None,
+               num_processes=1, early_stop=True):
         """ Battle the 2 NN against each other and
-            return the winner if they win 55% of the matches """
+            return the winner if they win 55% of the matches.
+
+        The matches are spread over num_processes processes. With
+        early_stop a sequential test ends the battle as soon as the
+        decision is settled, otherwise all episodes are played. """
         logger.info("Battle the nets to the death in the Arena")
-        new_wins = 0
-
-        for _ in tqdm(range(episodes)):
-            with torch.no_grad():
-                winner = self.play_match(search_depth)
-                logger.debug("%s wins!" % winner)
-            if winner == "new":
-                new_wins += 1
-
-        winning_ratio = new_wins / episodes
-        logger.info("Winning ratio is: {}".format(winning_ratio))
-        if winning_ratio >= 0.55:
+        test = SequentialTest()
+        decision = None
+
+        for winner in tqdm(self.results(episodes, search_depth, batch_size,
+                                        cache, num_processes),
+                           total=episodes):
+            logger.debug("%s wins!" % winner)
+            test.update(winner)
+            decision = test.decision()
+            if early_stop and decision is not None:
+                break
+
+        if cache is not None and num_processes == 1:
+            logger.info("Evaluation cache: {}".format(cache.stats()))
+        winning_ratio = test.score / max(test.games, 1)
+        if not early_stop or decision is None:
+            # Undecided after every episode, fall back to the ratio
+            decision = winning_ratio >= WINNING_RATIO
+        logger.info("Winning ratio is: {} after {} of {} games. Decision: {}"
+                    " with confidence {:.3f}"
+                    .format(winning_ratio, test.games, episodes,
+                            "promote" if decision else "keep",
+                            test.confidence()))
+        if decision:
             logger.info("New neural net is better!")
             return self.new_net
         else:
             logger.info("Reigning champion lives on!")
             return self.best_net
 
-    def play_match(self, search_depth):
+    def results(self, episodes, search_depth, batch_size, cache,
+                num_processes):
+        """ Yield the winner of each match in the order the matches were
+            started, as soon as it is known. Completion order would bias an
+            early stop whenever game length goes with the result. The pool
+            is shut down when the caller stops early """
+        if num_processes <= 1:
+            for _ in range(episodes):
+                # Grad mode stays as it was while the caller runs
+                with torch.no_grad():
+                    result = self.play_match(search_depth, batch_size,
+                                             cache)
+                yield result
+            return
+
+        cache_size = cache.max_entries if cache is not None else 0
+        ctx = mp.get_context("spawn")
+        pool = ctx.Pool(num_processes, initializer=init_arena_worker,
+                        initargs=(state_dict(self.best_net),
+                                  state_dict(self.new_net), cache_size,
+                                  self.tablebase, self.flat_tree))
+        try:
+            yield from pool.imap(
+                arena_worker_match, [(search_depth, batch_size)] * episodes)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def play_match(self, search_depth, batch_size=1, cache=None):
         # Switch which net goes first randomly
         if np.random.uniform(0, 1) <= 0.5:
             first = self.new_net
@@ -51,24 +147,39 @@ class Arena:
             f = "best"
             s = "new"
 
+        search, advance_root = tree_search(self.flat_tree)
         game = Board()
         winner = 0
         temp = 0.1
         game_over = False
+        # Each net keeps its own tree for the whole match
+        first_root, second_root = None, None
 
         while game_over is False:
-            if game.player == 1:
-                root = search(game, search_depth, first)
-                policy = get_policy(root, temp)
+            solved = self.tablebase.probe(game) \
+                if self.tablebase is not None else None
+            if solved is not None:
+                # Solved endgame, no need to search
+                move = solved[1]
             else:
-                root = search(game, search_depth, second)
-                policy = get_policy(root, temp)
+                if game.player == 1:
+                    first_root = search(game, search_depth, first,
+                                        batch_size, first_root, cache,
+                                        self.tablebase)
+                    policy = get_policy(first_root, temp)
+                else:
+                    second_root = search(game, search_depth, second,
+                                         batch_size, second_root, cache,
+                                         self.tablebase)
+                    policy = get_policy(second_root, temp)
 
-            # Process best move
-            legal_moves = game.get_legal_moves()
-            policy = game.policy_for_legal_moves(legal_moves, policy)
-            move = np.random.choice(legal_moves, p=policy)
+                # Process best move
+                legal_moves = game.get_legal_moves()
+                policy = game.policy_for_legal_moves(legal_moves, policy)
+                move = np.random.choice(legal_moves, p=policy)
             game.process_move(move)
+            first_root = advance_root(first_root, move)
+            second_root = advance_root(second_root, move)
 
             if game.is_game_over():
                 game_over = True
@@ -80,3 +191,34 @@ class Arena:
             return s
         else:
             return None
+
+
+def state_dict(net):
+    return {k: v.cpu() for k, v in net.state_dict().items()}
+
+
+# Arena and cache of an arena worker process, set by init_arena_worker
+worker_arena, worker_cache = None, None
+
+
+def init_arena_worker(best_state, new_state, cache_size, tablebase,
+                      flat_tree=False):
+    global worker_arena, worker_cache
+    from NeuralNet import JasonNet
+
+    torch.set_num_threads(1)
+    nets = []
+    for net_state in (best_state, new_state):
+        net = JasonNet()
+        net.load_state_dict(net_state)
+        net.eval()
+        nets.append(net)
+    worker_arena = Arena(*nets, tablebase, flat_tree)
+    worker_cache = EvalCache(cache_size) if cache_size > 0 else None
+
+
+def arena_worker_match(args):
+    search_depth, batch_size = args
+    with torch.no_grad():
+        return worker_arena.play_match(search_depth, batch_size,
+                                       worker_cache)
@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from rules.Mancala import Board
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+SUITES = ("startup", "perft", "search", "inference", "train")
+
+# Modules run as programs, timed by importing them in a fresh interpreter
+ENTRY_POINTS = ("Driver", "PlayAi", "Human", "Mcts", "AlphaBeta",
+                "Tablebase", "ReplayStorage", "OptimizedNet",
+                "rules.Reference")
+
+IMPORT_SCRIPT = """import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, "torch" in sys.modules,
+      "matplotlib" in sys.modules)"""
+
+
+def perft(board, depth):
+    """ Number of positions reached by playing every legal move sequence
+        of depth moves. Finished games count as a position """
+    if depth == 0 or board.game_over:
+        return 1
+    nodes = 0
+    for move in board.legal_moves:
+        child = board.clone()
+        child.process_move(move)
+        nodes += perft(child, depth - 1)
+    return nodes
+
+
+def result(value, unit, higher_is_better=True, **details):
+    entry = {"value": value, "unit": unit,
+             "higher_is_better": higher_is_better}
+    entry.update(details)
+    return entry
+
+
+def bench_startup(modules, repeats):
+    """ Median time to import each module in a new interpreter and
+        whether that imported torch or matplotlib """
+    src = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        timings = []
+        for _ in range(repeats):
+            output = subprocess.run(
+                [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+                cwd=src, capture_output=True, text=True, check=True).stdout
+            seconds, torch_loaded, matplotlib_loaded = output.split()[-3:]
+            timings.append(float(seconds))
+        results["startup/%s" % module] = result(
+            1000 * float(np.median(timings)), "ms", higher_is_better=False,
+            imports_torch=torch_loaded == "True",
+            imports_matplotlib=matplotlib_loaded == "True")
+    return results
+
+
+def bench_perft(depths):
+    results = {}
+    for depth in depths:
+        start = time.perf_counter()
+        nodes = perft(Board(), depth)
+        elapsed = time.perf_counter() - start
+        results["perft/depth%d" % depth] = result(
+            nodes / elapsed, "nodes/s", nodes=nodes, seconds=elapsed)
+    return results
+
+
+def bench_search(net, budgets, batch_sizes):
+    """ Simulations per second from the opening position, a fresh tree
+        for every measurement """
+    import Mcts
+    import FlatTree
+    from MonteCarlo import search
+
+    Mcts.tqdm = lambda iterable: iterable  # keep the output readable
+    results = {}
+    for budget in budgets:
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            search(Board(), budget, net, batch_size)
+            elapsed = time.perf_counter() - start
+            results["search/monte_carlo/sims%d/bs%d" % (budget, batch_size)] \
+                = result(budget / elapsed, "sims/s", seconds=elapsed)
+
+            start = time.perf_counter()
+            tree = FlatTree.search(Board(), budget, net, batch_size)
+            elapsed = time.perf_counter() - start
+            results["search/flat_tree/sims%d/bs%d" % (budget, batch_size)] \
+                = result(budget / elapsed, "sims/s", seconds=elapsed,
+                         bytes_per_node=tree.nbytes_per_node())
+
+        tree = Mcts.Tree(net)
+        start = time.perf_counter()
+        tree.think(Board(), budget)
+        elapsed = time.perf_counter() - start
+        results["search/tree/sims%d" % budget] = result(
+            budget / elapsed, "sims/s", seconds=elapsed)
+    return results
+
+
+def bench_inference(net, batch_sizes, repeats):
+    """ Median forward latency of the net per batch size """
+    device = next(net.parameters()).device
+    results = {}
+    for batch_size in batch_sizes:
+        boards = torch.randint(0, 10, (batch_size, 1, 15),
+                               dtype=torch.float32, device=device)
+        timings = []
+        with torch.no_grad():
+            net(boards)  # warm up
+            for _ in range(repeats):
+                start = time.perf_counter()
+                net(boards)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                timings.append(time.perf_counter() - start)
+        latency = float(np.median(timings))
+        results["inference/bs%d" % batch_size] = result(
+            latency * 1000, "ms", higher_is_better=False,
+            samples_per_sec=batch_size / latency)
+    return results
+
+
+def bench_train(net, samples, bs, epochs):
+    """ Samples per second of Train.train on random positions. It runs in
+        a scratch directory as it saves checkpoints and plots """
+    import torch.optim as optim
+    import Train
+
+    rng = np.random.RandomState(0)
+    policies = rng.random_sample((samples, 14)).astype(np.float32)
+    dataset = (rng.randint(0, 10, (samples, 15)).astype(np.int8),
+               policies / policies.sum(axis=1, keepdims=True),
+               rng.randint(-1, 2, samples).astype(np.int8))
+    optimizer = optim.Adam(net.parameters(), lr=1e-4)
+    scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=[50])
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        os.mkdir("model_data")
+        try:
+            start = time.perf_counter()
+            Train.train(net, dataset, optimizer, scheduler, 0, bs, epochs)
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    net.eval()
+    return {"train/bs%d" % bs: result(samples * epochs / elapsed,
+                                      "samples/s", seconds=elapsed)}
+
+
+def run_benchmarks(suites=SUITES, quick=False, seed=0):
+    from NeuralNet import JasonNet
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    net = JasonNet()
+    if torch.cuda.is_available():
+        net.cuda()
+    net.eval()
+
+    results = {}
+    if "startup" in suites:
+        results.update(bench_startup(ENTRY_POINTS, 1 if quick else 3))
+    if "perft" in suites:
+        results.update(bench_perft([3, 4] if quick else [4, 5, 6]))
+    if "search" in suites:
+        results.update(bench_search(net, [100] if quick else [200, 800],
+                                    [1, 16]))
+    if "inference" in suites:
+        results.update(bench_inference(
+            net, [1, 16, 256] if quick else [1, 4, 16, 64, 256, 1024],
+            20 if quick else 100))
+    if "train" in suites:
+        results.update(bench_train(net, 1024 if quick else 8192, 32,
+                                   1 if quick else 2))
+    return {"meta": {"python": platform.python_version(),
+                     "torch": torch.__version__,
+                     "machine": platform.machine(),
+                     "cpus": os.cpu_count(),
+                     "cuda": torch.cuda.is_available(),
+                     "quick": quick,
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "results": results}
+
+
+def compare(report, baseline, tolerance):
+    """ Names of the results more than tolerance (a fraction) worse than
+        in baseline, logging every result found in both """
+    slower = []
+    for name, entry in sorted(report["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None or not base["value"]:
+            continue
+        change = entry["value"] / base["value"] - 1
+        if not entry["higher_is_better"]:
+            change = base["value"] / entry["value"] - 1
+        flag = change < -tolerance
+        if flag:
+            slower.append(name)
+        logger.info("%-36s %12.2f %-9s %+7.1f%%%s"
+                    % (name, entry["value"], entry["unit"], 100 * change,
+                       "  SLOWER" if flag else ""))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--suites", default=",".join(SUITES),
+                        help="Comma separated subset of %s"
+                             % ",".join(SUITES))
+    parser.add_argument("--quick", action="store_true",
+                        help="Smaller sizes for a fast check")
+    parser.add_argument("--output", default=None,
+                        help="Write the JSON report to this file")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Flag results slower than the baseline by "
+                             "more than this fraction")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.suites.split(","), args.quick)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(report, json.load(f), args.tolerance)
+        if slower:
+            logger.warning("Slower than the baseline: %s"
+                           % ", ".join(slower))
+            raise SystemExit(1)
+        logger.info("No slowdowns against %s" % args.baseline)
@@ -0,0 +1,111 @@
+import logging
+import os
+import pickle
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+
+def snapshot(state):
+    """ Copy of a state dict, or of nested dicts and lists of them, with
+        every tensor cloned to the CPU so training can go on changing
+        the originals while the copy is written """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def save_atomic(data, path, save=torch.save):
+    """ Write data with save to a temporary file renamed over path, so a
+        crash or a reader never sees half a file """
+    tmp_path = path + ".tmp"
+    save(data, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def pickle_save(data, path):
+    with open(path, "wb") as f:
+        pickle.dump(data, f)
+
+
+def rng_state():
+    """ States of every random number generator training uses """
+    state = {"torch": torch.get_rng_state(),
+             "numpy": np.random.get_state(),
+             "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_checkpoint(path):
+    """ Checkpoint saved by CheckpointWriter, None if there is none """
+    if not os.path.isfile(path):
+        return None
+    # Checkpoints hold optimizer state and RNG states next to the tensors
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+class CheckpointWriter:
+    """ Writes checkpoints from a background thread.
+
+    save takes a snapshot of the data right away and returns; the thread
+    writes it with save_atomic. Only the newest pending write of a path
+    is kept when the disk falls behind. close waits for every write. """
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def save(self, data, path, save=torch.save):
+        with self.lock:
+            queued = path in self.pending
+            self.pending[path] = (snapshot(data), save)
+        if not queued:
+            self.jobs.put(path)
+
+    def run(self):
+        while True:
+            path = self.jobs.get()
+            if path is None:
+                break
+            with self.lock:
+                data, save = self.pending.pop(path)
+            try:
+                save_atomic(data, path, save)
+            except Exception as error:
+                # Keep serving the queue, or flush and close would hang
+                logger.error("Could not write %s: %s" % (path, error))
+            finally:
+                self.jobs.task_done()
+
+    def flush(self):
+        """ Wait until every checkpoint saved so far is on disk """
+        self.jobs.join()
+
+    def close(self):
+        self.flush()
+        self.jobs.put(None)
+        self.thread.join()
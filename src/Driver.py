@@ -1,23 +1,28 @@
 import logging
 import os
-import pickle
 from argparse import ArgumentParser
-from Train import train_net
+from Train import train_net, checkpoint_path
 from Arena import Arena
 from MonteCarlo import run_monte_carlo
 from Generator import generate_data
 from NeuralNet import JasonNet
+from EvalCache import EvalCache
+from Tablebase import open_tablebase
+from Pipeline import run_pipeline
+from ReplayStorage import ReplayBuffer
+from OptimizedNet import INFERENCE_MODES
+from Checkpoint import CheckpointWriter
 
 logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 logger = logging.getLogger(__file__)
+REPLAY_PATH = "./model_data/replay.npz"
 
 
-def save_as_pickle(iteration, nn):
-    net_name = "winner_iter%d.pkl" % iteration
-    file_name = os.path.join("./model_data/", net_name)
-    with open(file_name, 'wb') as output:
-        pickle.dump(nn, output)
+def save_winner(writer, iteration, nn):
+    """ Weights of the winning net, load with load_state_dict """
+    net_name = "winner_iter%d.pth.tar" % iteration
+    writer.save(nn.state_dict(), os.path.join("./model_data/", net_name))
 
 
 if __name__ == "__main__":
@@ -32,11 +37,55 @@ if __name__ == "__main__":
                         help="Nbr of games to play")
     parser.add_argument("--search_depth", type=int, default=300,
                         help="How deep in tree to search")
+    parser.add_argument("--search_batch_size", type=int, default=1,
+                        help="Nbr of leaves evaluated together in search")
+    parser.add_argument("--max_tree_nodes", type=int, default=200000,
+                        help="Max positions kept in the search tree")
+    parser.add_argument("--eval_cache_size", type=int, default=500000,
+                        help="Nbr of net predictions to cache, 0 is off")
+    parser.add_argument("--inference_mode", default="float",
+                        choices=INFERENCE_MODES,
+                        help="Net used by self-play: float, a TorchScript "
+                             "graph or one with int8 Linear layers")
+    parser.add_argument("--search_stats", default=None,
+                        help="JSONL file for per game and per iteration "
+                             "search phase timings, off if not given")
+    parser.add_argument("--flat_tree", action="store_true",
+                        help="Keep the MonteCarlo and arena search trees "
+                             "in NumPy arrays, see FlatTree.py")
+    parser.add_argument("--tablebase", default=None,
+                        help="Endgame tablebase built with Tablebase.py")
+    parser.add_argument("--arena_num_processes", type=int, default=5,
+                        help="Nbr of processes to play arena matches")
+    parser.add_argument("--no_early_stop", action="store_true",
+                        help="Play every arena match instead of stopping "
+                             "once the promotion is settled")
     parser.add_argument("--bs", type=int, default=32, help="Batch size")
     parser.add_argument("--lr", type=int, default=1e-4,
                         help="Learning Rate")
     parser.add_argument("--epochs", type=int, default=25,
                         help="Number of epochs to train")
+    parser.add_argument("--replay_window", type=int, default=5,
+                        help="Train on the positions of this many latest "
+                             "iterations")
+    parser.add_argument("--replay_capacity", type=int, default=1 << 19,
+                        help="Most positions the replay buffer holds")
+    parser.add_argument("--replay_recency", type=float, default=1.0,
+                        help="Below 1, sample the replay buffer with "
+                             "positions of each older iteration this much "
+                             "less likely")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Run self-play, training and the arena at "
+                             "the same time, see Pipeline.py. Iterations "
+                             "are then learner rounds")
+    parser.add_argument("--steps_per_round", type=int, default=1000,
+                        help="Pipeline mini batches between checkpoints")
+    parser.add_argument("--window", type=int, default=200000,
+                        help="Pipeline trains on this many newest "
+                             "positions")
+    parser.add_argument("--min_positions", type=int, default=10000,
+                        help="Positions the pipeline waits for before "
+                             "training")
 
     args = parser.parse_args()
 
@@ -50,27 +99,77 @@ if __name__ == "__main__":
     current_NN = net
     best_NN = net
 
+    # Predictions are dropped automatically when the weights change
+    cache = EvalCache(args.eval_cache_size) \
+        if args.eval_cache_size > 0 else None
+
+    tablebase = open_tablebase(args.tablebase)
+
     if not os.path.isdir("model_data"):
         os.mkdir("model_data")
 
+    if args.pipeline:
+        run_pipeline(current_NN, args.total_iterations,
+                     args.steps_per_round, args.window, args.min_positions,
+                     args.MCTS_num_processes, search_depth, args.lr,
+                     args.bs, episodes // 2, args.search_batch_size,
+                     args.max_tree_nodes, args.eval_cache_size, tablebase,
+                     args.flat_tree, args.inference_mode, args.iteration)
+        raise SystemExit(0)
+
+    # Saved after every iteration so a resumed run does not reload the
+    # shards of the whole window
+    replay = ReplayBuffer(args.replay_capacity, args.replay_window)
+    if os.path.isfile(REPLAY_PATH):
+        saved = ReplayBuffer.restore(REPLAY_PATH, args.replay_capacity,
+                                     args.replay_window)
+        if max(saved.iterations(), default=-1) < args.iteration:
+            replay = saved
+        else:
+            logger.warning("Ignoring %s, it holds iteration %d or later"
+                           % (REPLAY_PATH, args.iteration))
+    first = max(args.iteration - args.replay_window + 1, 0)
+    replay.load_iterations(range(first, args.iteration))
+
+    # Checkpoints and winners are written in the background
+    writer = CheckpointWriter()
+
     logger.info("Starting to train...")
     for i in range(args.iteration, args.total_iterations):
         logger.info(F"Iteration {i}")
 
-        # Play a number of Episodes (games) of self play to generate data
-        generate_data(current_NN, episodes, search_depth, i)
+        # A run stopped during training picks up from its checkpoint,
+        # the games of the iteration are already played
+        resume = i == args.iteration and os.path.isfile(checkpoint_path(i))
+        if resume:
+            logger.info("Found %s, resuming training" % checkpoint_path(i))
+        else:
+            # Play a number of Episodes (games) of self play to generate
+            # data
+            generate_data(current_NN, episodes, search_depth, i,
+                          args.max_tree_nodes, args.MCTS_num_processes,
+                          cache, tablebase, args.search_stats,
+                          args.inference_mode)
 
         # original monte carlo
-        #run_monte_carlo(current_NN, 0, i, episodes, search_depth)
+        #run_monte_carlo(current_NN, 0, i, episodes, search_depth,
+        #                args.search_batch_size, args.MCTS_num_processes,
+        #                cache, args.search_stats, args.flat_tree)
 
         # Train NN from dataset of monte carlo tree search above
-        train_net(current_NN, i, args.lr, args.bs, args.epochs)
+        train_net(current_NN, i, args.lr, args.bs, args.epochs, replay,
+                  args.replay_recency, resume, writer)
+        replay.snapshot(REPLAY_PATH)
 
         # Fight new version against reigning champion in the Arena
         # Even with first iteration just battle against yourself
-        arena = Arena(best_NN, current_NN)
-        best_NN = arena.battle(episodes//2, search_depth)
-        # Save the winning net as a Pickle for battle later
-        save_as_pickle(i, best_NN)
+        arena = Arena(best_NN, current_NN, tablebase, args.flat_tree)
+        best_NN = arena.battle(episodes//2, search_depth,
+                               args.search_batch_size, cache,
+                               args.arena_num_processes,
+                               not args.no_early_stop)
+        # Save the winning net for battle later
+        save_winner(writer, i, best_NN)
 
+    writer.close()
     print("End of the main driver program. Training has completed!")
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+
+class EvalCache:
+    """ LRU cache of (policy, value) predictions of the net.
+
+    Entries are keyed by the Zobrist hash of the position together with
+    the net and its version. JasonNet bumps its version whenever weights
+    are loaded or it is put in training mode, so the predictions of older
+    weights are dropped automatically. """
+
+    def __init__(self, max_entries=500000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.versions = {}  # id(net) -> version the entries were made with
+        self.hits = 0
+        self.misses = 0
+
+    def model_key(self, net):
+        version = getattr(net, "version", 0)
+        net_id = id(net)
+        if self.versions.get(net_id, version) != version:
+            self.invalidate(net_id)
+        self.versions[net_id] = version
+        return net_id, version
+
+    def invalidate(self, net_id):
+        """ Drop every entry made by the net with id net_id """
+        for key in [key for key in self.entries if key[0] == net_id]:
+            del self.entries[key]
+
+    def lookup(self, net, position):
+        """ Return a copy of the cached (policy, value) or None """
+        key = self.model_key(net) + (position,)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        policy, value = entry
+        return policy.copy(), value
+
+    def store(self, net, position, policy, value):
+        key = self.model_key(net) + (position,)
+        self.entries[key] = (policy.copy(), float(value))
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hit_rate(), "entries": len(self.entries)}
+
+    def clear(self):
+        self.entries.clear()
+        self.versions.clear()
+        self.hits = 0
+        self.misses = 0
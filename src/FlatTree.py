@@ -0,0 +1,297 @@
+import math
+import time
+import tracemalloc
+
+import numpy as np
+
+import MonteCarlo
+from rules.Mancala import Board, SIDE_SHIFT
+from Node import VIRTUAL_LOSS
+
+# By Board.legal_mask: the slots holding marbles, and the value sums a row
+# starts with, -inf for the empty pits so they are never selected
+SLOT_LEGAL = np.array([[mask >> slot & 1 for slot in range(6)]
+                       for mask in range(64)], dtype=bool)
+EMPTY_VALUE = np.where(SLOT_LEGAL, 0, -np.inf).astype(np.float32)
+
+class FlatTree:
+    """ Search tree of MonteCarlo.search stored as a struct of arrays.
+
+    Row i of every array describes node i: its board (15 int8 in the
+    layout of Board.current_board), whether the game is over, its Zobrist
+    and mirror Zobrist hashes, the parent row and the slot of the move
+    from it, and per slot the child row (-1 until created), prior, visits
+    and value sum. The 6 slots are the pits of the player to move, the
+    only ones that can be played. An empty pit has a value sum of -inf so
+    selection is one argmax without a mask. The statistics of a node live
+    in its parent's row like in Node, so a root has 0 visits. The arrays
+    start at capacity rows and double when full. The root is row 0.
+
+    It makes the same choices as the Node tree: with the same random
+    seed both give identical visit counts. """
+
+    def __init__(self, game, capacity=1024):
+        self.size = 0
+        self.allocate(capacity)
+        self.root = self.add_node(-1, -1, game)
+
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.boards = np.zeros((capacity, 15), dtype=np.int8)
+        self.game_over = np.zeros(capacity, dtype=bool)
+        self.hashes = np.zeros((capacity, 2), dtype=np.uint64)
+        self.parent = np.full(capacity, -1, dtype=np.int32)
+        self.slot = np.full(capacity, -1, dtype=np.int8)
+        self.expanded = np.zeros(capacity, dtype=bool)
+        self.children = np.full((capacity, 6), -1, dtype=np.int32)
+        self.priors = np.zeros((capacity, 6), dtype=np.float32)
+        self.child_visits = np.zeros((capacity, 6), dtype=np.float32)
+        self.child_value = np.zeros((capacity, 6), dtype=np.float32)
+
+    COLUMNS = ("boards", "game_over", "hashes", "parent", "slot", "expanded",
+               "children", "priors", "child_visits", "child_value")
+
+    def grow(self):
+        old = {name: getattr(self, name) for name in self.COLUMNS}
+        self.allocate(self.capacity * 2)
+        for name, array in old.items():
+            getattr(self, name)[:self.size] = array[:self.size]
+
+    def nbytes_per_node(self):
+        return sum(getattr(self, name).nbytes
+                   for name in self.COLUMNS) / self.capacity
+
+    def add_node(self, parent, slot, board):
+        if self.size == self.capacity:
+            self.grow()
+        row = self.size
+        self.size += 1
+        self.boards[row] = board.current_board
+        self.game_over[row] = board.game_over
+        self.hashes[row] = board.zobrist, board.mirror_zobrist
+        self.parent[row] = parent
+        self.slot[row] = slot
+        if parent >= 0:
+            self.children[parent, slot] = row
+        return row
+
+    def board(self, row):
+        zobrist, mirror_zobrist = self.hashes[row].tolist()
+        return Board.from_state(self.boards[row].tolist(),
+                                bool(self.game_over[row]),
+                                (zobrist, mirror_zobrist))
+
+    def first_pit(self, row):
+        """ Pit of slot 0 of row, the first pit of the player to move """
+        return SIDE_SHIFT[self.boards[row, 14]]
+
+    @property
+    def child_number_visits(self):
+        """ Visits of the moves of the root by pit, as Node has them """
+        visits = np.zeros(14, dtype=np.float32)
+        first = self.first_pit(self.root)
+        visits[first:first + 6] = self.child_visits[self.root]
+        return visits
+
+    @property
+    def has_children(self):
+        return bool(self.expanded[self.root])
+
+    def select_leaf(self):
+        """ FlatLeaf of the row reached, with the board of a new row """
+        row, board = self.root, None
+        # Visits of row, 0 for the root like in Node
+        visits = 0.0
+        child_visits, child_value = self.child_visits, self.child_value
+        while self.expanded[row]:
+            counts = child_visits[row] + 1
+            score = child_value[row] / counts + \
+                math.sqrt(visits) * (self.priors[row] / counts)
+            slot = int(score.argmax())
+            visits = child_visits[row, slot]
+            child = self.children[row, slot]
+            board = None
+            if child < 0:
+                board = self.board(row)
+                board.process_move(slot + self.first_pit(row))
+                child = self.add_node(row, slot, board)
+            row = child
+        return FlatLeaf(self, int(row), board)
+
+    def expand(self, row, policy, legal_mask):
+        """ Set the priors of row from policy over the moves of legal_mask,
+            the Board.legal_mask of row, with Dirichlet noise on the
+            children of the root as in Node. Policies are probabilities,
+            so the abs of Node is left out """
+        first = self.first_pit(row)
+        legal = SLOT_LEGAL[legal_mask]
+        self.expanded[row] = legal_mask != 0
+        self.child_value[row] = EMPTY_VALUE[legal_mask]
+        priors = policy[first:first + 6] * legal
+
+        parent = self.parent[row]
+        if parent >= 0 and self.parent[parent] < 0:
+            legal_slots = np.flatnonzero(legal)
+            priors[legal_slots] = 0.75 * priors[legal_slots] + \
+                0.25 * np.random.dirichlet(np.zeros(
+                    [len(legal_slots)], dtype=np.float32) + 192)
+        self.priors[row] = priors
+
+    def update_path(self, row, visits, value):
+        parent = self.parent[row]
+        while parent >= 0:
+            slot = self.slot[row]
+            self.child_visits[parent, slot] += visits
+            self.child_value[parent, slot] += value
+            row, parent = parent, self.parent[parent]
+
+    def backup(self, row, value):
+        self.update_path(row, 1, value)
+
+    def add_virtual_loss(self, row):
+        self.update_path(row, 1, -VIRTUAL_LOSS)
+
+    def revert_virtual_loss(self, row):
+        self.update_path(row, -1, VIRTUAL_LOSS)
+
+    def subtree(self, move):
+        """ New tree holding the subtree reached by playing move from the
+            root, or None if there is none. Rows outside it are dropped """
+        child = self.children[self.root, move - self.first_pit(self.root)]
+        if child < 0:
+            return None
+        levels, level = [], np.array([child])
+        while len(level):
+            levels.append(level)
+            level = self.children[level].ravel()
+            level = level[level >= 0]
+        rows = np.concatenate(levels)
+
+        tree = FlatTree.__new__(FlatTree)
+        tree.size = len(rows)
+        tree.allocate(max(1024, 1 << (len(rows) - 1).bit_length()))
+        tree.root = 0
+        new_row = np.full(self.size, -1, dtype=np.int32)
+        new_row[rows] = np.arange(len(rows))
+        for name in self.COLUMNS:
+            getattr(tree, name)[:len(rows)] = getattr(self, name)[rows]
+        children = self.children[rows]
+        tree.children[:len(rows)] = np.where(children >= 0,
+                                             new_row[children], -1)
+        tree.parent[:len(rows)] = new_row[self.parent[rows]]
+        tree.parent[0] = -1
+        return tree
+
+
+class FlatLeaf:
+    """ Row of a FlatTree with the part of the Node interface used by the
+        select, evaluate and backup helpers of MonteCarlo. Leaves of the
+        same row are equal, so a row selected twice in a round is one
+        leaf to them like a Node is. The board is built when first used """
+
+    __slots__ = ("tree", "row", "board")
+
+    def __init__(self, tree, row, board=None):
+        self.tree = tree
+        self.row = row
+        self.board = board
+
+    def __eq__(self, other):
+        return self.row == other.row and self.tree is other.tree
+
+    def __hash__(self):
+        return self.row
+
+    @property
+    def game(self):
+        if self.board is None:
+            self.board = self.tree.board(self.row)
+        return self.board
+
+    @property
+    def parent(self):
+        parent = self.tree.parent[self.row]
+        return FlatLeaf(self.tree, int(parent)) if parent >= 0 else None
+
+    @property
+    def has_children(self):
+        return bool(self.tree.expanded[self.row])
+
+    @property
+    def legal_moves(self):
+        return self.game.legal_moves
+
+    def expand(self, policy):
+        self.tree.expand(self.row, policy, self.game.legal_mask)
+
+    def backup(self, value):
+        self.tree.backup(self.row, value)
+
+    def add_virtual_loss(self):
+        self.tree.add_virtual_loss(self.row)
+
+    def revert_virtual_loss(self):
+        self.tree.revert_virtual_loss(self.row)
+
+
+def advance_root(tree, move):
+    """ Same as MonteCarlo.advance_root for a FlatTree """
+    return tree.subtree(move) if tree is not None else None
+
+
+def search(game, sim_nbr, net, batch_size=1, root=None, cache=None,
+           tablebase=None, stats=None):
+    """ MonteCarlo.search on a FlatTree, root being the tree kept by
+        advance_root to continue from. Returns the tree """
+    tree = root if root is not None else FlatTree(game)
+    return MonteCarlo.search(game, sim_nbr, net, batch_size, tree, cache,
+                             tablebase, stats)
+
+
+def compare_with_nodes(net, simulations=800, batch_sizes=(1, 8), seed=0):
+    """ Run MonteCarlo.search and the flat search from the opening and
+        after reusing the subtree of a move. Returns whether the visits
+        match and the speed and memory per node of each """
+    report = {"identical": True}
+    for batch_size in batch_sizes:
+        roots, speed = {}, {}
+        for name, run, advance in (
+                ("node", MonteCarlo.search, MonteCarlo.advance_root),
+                ("flat", search, advance_root)):
+            np.random.seed(seed)
+            start = time.time()
+            root = run(Board(), simulations, net, batch_size)
+            visits = root.child_number_visits.copy()
+            move = int(np.argmax(visits))
+            board = Board()
+            board.process_move(move)
+            root = run(board, 2 * simulations, net, batch_size,
+                       advance(root, move))
+            speed[name] = 2 * simulations / (time.time() - start)
+            roots[name] = (visits, root.child_number_visits.copy())
+        same = all(np.array_equal(a, b)
+                   for a, b in zip(roots["node"], roots["flat"]))
+        report["identical"] = report["identical"] and same
+        report["sims_per_sec_bs%d" % batch_size] = speed
+
+    # Memory of the trees of one search each
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    root = MonteCarlo.search(Board(), simulations, net)
+    node_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    nodes, stack = 0, [root]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        stack.extend(node.children.values())
+    tree = search(Board(), simulations, net)
+    report["bytes_per_node"] = {"node": node_bytes / nodes,
+                                "flat": tree.nbytes_per_node()}
+    return report
+
+
+if __name__ == "__main__":
+    from NeuralNet import JasonNet
+
+    print(compare_with_nodes(JasonNet().eval()))
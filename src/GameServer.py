@@ -0,0 +1,370 @@
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from rules.Mancala import Board
+from MonteCarlo import advance_root, canonical_boards, evaluate_boards, \
+    get_policy, lookup_leaves, next_round, search_rounds, store_evaluations
+from Node import Node
+from EvalCache import EvalCache
+from Tablebase import open_tablebase
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+# Protocol, one line per message.
+#   server: WELCOME <player of the client>, BOARD <15 numbers>,
+#           YOUR_MOVE <legal moves>, AI_MOVE <move> <milliseconds>,
+#           ILLEGAL <move>, GAME_OVER <winner 1, -1 or 0> <text>,
+#           STATS <latency percentiles>, ERROR <text>
+#   client: MOVE <pit> (or just <pit>), NEW, STATS, QUIT
+PERCENTILES = (50, 90, 99)
+
+
+class BatchEvaluator:
+    """ One net shared by every session.
+
+    evaluate queues boards and waits for their policies and values. The
+    run task takes everything queued once max_batch boards are waiting or
+    max_latency seconds after the first, and runs the net on a thread so
+    sessions keep searching while it works. """
+
+    def __init__(self, net, max_batch=256, max_latency=0.002):
+        self.net = net
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.requests = []
+        self.queued = 0
+        self.pending = asyncio.Event()
+        self.full = asyncio.Event()
+        self.executor = ThreadPoolExecutor(1)
+        self.batches = 0
+        self.positions = 0
+
+    async def evaluate(self, boards):
+        future = asyncio.get_running_loop().create_future()
+        self.requests.append((boards, future))
+        self.queued += len(boards)
+        self.pending.set()
+        if self.queued >= self.max_batch:
+            self.full.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.pending.wait()
+            try:
+                await asyncio.wait_for(self.full.wait(), self.max_latency)
+            except asyncio.TimeoutError:
+                pass
+            requests, self.requests, self.queued = self.requests, [], 0
+            self.pending.clear()
+            self.full.clear()
+
+            boards = [board for request, _ in requests for board in request]
+            try:
+                policies, values = await loop.run_in_executor(
+                    self.executor, evaluate_boards, self.net, boards)
+            except Exception as error:
+                for _, future in requests:
+                    if not future.cancelled():
+                        future.set_exception(error)
+                continue
+            self.batches += 1
+            self.positions += len(boards)
+            start = 0
+            for request, future in requests:
+                end = start + len(request)
+                if not future.cancelled():
+                    future.set_result((policies[start:end],
+                                       values[start:end]))
+                start = end
+
+    def mean_batch(self):
+        return self.positions / max(self.batches, 1)
+
+
+class LatencyStats:
+    """ Seconds the AI took for its most recent moves """
+
+    def __init__(self, max_moves=100000):
+        self.latencies = deque(maxlen=max_moves)
+
+    def add(self, seconds):
+        self.latencies.append(seconds)
+
+    def summary(self):
+        if not self.latencies:
+            return "moves=0"
+        values = np.percentile(np.array(self.latencies) * 1000, PERCENTILES)
+        return "moves=%d " % len(self.latencies) + " ".join(
+            "p%d=%.1fms" % (p, v) for p, v in zip(PERCENTILES, values))
+
+
+async def search(game, sim_nbr, evaluator, batch_size=8, root=None,
+                 cache=None, tablebase=None):
+    """ MonteCarlo.search with the net calls going through evaluator, so
+        other sessions run while this one waits """
+    if root is None:
+        root = Node(game, move=None, parent=None)
+    rounds = search_rounds(root, sim_nbr, batch_size)
+    leaves = next(rounds, None)
+    while leaves is not None:
+        evaluations, pending = lookup_leaves(leaves, evaluator.net, cache,
+                                             tablebase)
+        if pending:
+            policies, values = await evaluator.evaluate(
+                canonical_boards(pending))
+            store_evaluations(evaluations, pending, policies, values,
+                              evaluator.net, cache)
+        leaves = next_round(rounds, evaluations)
+    return root
+
+
+class GameServer:
+    def __init__(self, evaluator, depth, batch_size=8, cache=None,
+                 tablebase=None):
+        self.evaluator = evaluator
+        self.depth = depth
+        self.batch_size = batch_size
+        self.cache = cache
+        self.tablebase = tablebase
+        self.latency = LatencyStats()
+        self.sessions = 0
+
+    async def ai_move(self, game, root, temp):
+        solved = self.tablebase.probe(game) \
+            if self.tablebase is not None else None
+        if solved is not None:
+            return solved[1], root
+        root = await search(game, self.depth, self.evaluator,
+                            self.batch_size, root, self.cache,
+                            self.tablebase)
+        legal_moves = game.get_legal_moves()
+        policy = game.policy_for_legal_moves(legal_moves,
+                                             get_policy(root, temp))
+        return int(np.random.choice(legal_moves, p=policy)), root
+
+    def stats(self):
+        return "%s sessions=%d batches=%d mean_batch=%.1f" % (
+            self.latency.summary(), self.sessions, self.evaluator.batches,
+            self.evaluator.mean_batch())
+
+    async def session(self, reader, writer):
+        """ Play games with one client until it quits or disconnects """
+        self.sessions += 1
+
+        async def send(line):
+            writer.write((line + "\n").encode())
+            await writer.drain()
+
+        async def receive():
+            line = await reader.readline()
+            if not line:
+                return "QUIT", None
+            words = line.decode().split()
+            if not words:
+                return "", None
+            command = words[0].upper()
+            if command.lstrip("-").isdigit():
+                command, words = "MOVE", ["MOVE"] + words
+            argument = words[1] if len(words) > 1 else None
+            return command, argument
+
+        try:
+            while True:
+                human = random.choice((1, 2))
+                await send("WELCOME %d" % human)
+                if not await self.play(human, send, receive):
+                    return
+                while True:
+                    command, _ = await receive()
+                    if command == "NEW":
+                        break
+                    if command == "QUIT":
+                        return
+                    if command == "STATS":
+                        await send("STATS " + self.stats())
+                    else:
+                        await send("ERROR send NEW or QUIT")
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def play(self, human, send, receive):
+        """ Play one game, False if the client quit during it """
+        game, root, moves = Board(), None, 0
+        while not game.game_over:
+            await send("BOARD " + " ".join(map(str, game.current_board)))
+            if game.player != human:
+                temp = 1. if moves <= 5 else 0.1
+                start = time.perf_counter()
+                move, root = await self.ai_move(game, root, temp)
+                elapsed = time.perf_counter() - start
+                self.latency.add(elapsed)
+                await send("AI_MOVE %d %.1f" % (move, elapsed * 1000))
+            else:
+                await send("YOUR_MOVE " + " ".join(
+                    map(str, game.legal_moves)))
+                command, argument = await receive()
+                if command == "QUIT":
+                    return False
+                if command == "STATS":
+                    await send("STATS " + self.stats())
+                    continue
+                if command != "MOVE" or argument is None or \
+                        not argument.lstrip("-").isdigit():
+                    await send("ERROR send MOVE <pit>, STATS or QUIT")
+                    continue
+                move = int(argument)
+                if move not in game.legal_moves:
+                    await send("ILLEGAL %d" % move)
+                    continue
+            game.process_move(move)
+            root = advance_root(root, move)
+            moves += 1
+        await send("BOARD " + " ".join(map(str, game.current_board)))
+        await send("GAME_OVER %d %s" % (game.get_winner(),
+                                        game.get_winner_string()))
+        return True
+
+
+class StdioWriter:
+    """ stdout with the write and drain of an asyncio StreamWriter """
+
+    def write(self, data):
+        sys.stdout.write(data.decode())
+
+    async def drain(self):
+        sys.stdout.flush()
+
+    def close(self):
+        sys.stdout.flush()
+
+
+async def stdio_reader():
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    return reader
+
+
+async def bot_client(host, port, games, seed):
+    """ Client that plays random legal moves, for load tests """
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    while games > 0:
+        line = await reader.readline()
+        if not line:
+            break
+        words = line.decode().split()
+        if words[0] == "YOUR_MOVE":
+            writer.write(b"MOVE %s\n" % rng.choice(words[1:]).encode())
+        elif words[0] == "GAME_OVER":
+            games -= 1
+            writer.write(b"NEW\n" if games > 0 else b"QUIT\n")
+        await writer.drain()
+    writer.close()
+
+
+async def report(server, interval):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(server.stats())
+
+
+async def main(args, net):
+    evaluator = BatchEvaluator(net, args.max_batch,
+                               args.max_latency_ms / 1000)
+    cache = EvalCache(args.eval_cache_size) \
+        if args.eval_cache_size > 0 else None
+    server = GameServer(evaluator, args.search_depth,
+                        args.search_batch_size, cache,
+                        open_tablebase(args.tablebase))
+    tasks = [asyncio.ensure_future(evaluator.run()),
+             asyncio.ensure_future(report(server, args.report_every))]
+    try:
+        if args.stdio:
+            await server.session(await stdio_reader(), StdioWriter())
+            return
+        tcp = await asyncio.start_server(server.session, args.host,
+                                         args.port)
+        logger.info("Serving on %s:%d" % (args.host, args.port))
+        async with tcp:
+            if args.bots:
+                start = time.perf_counter()
+                await asyncio.gather(*[
+                    bot_client(args.host, args.port, args.bot_games, seed)
+                    for seed in range(args.bots)])
+                logger.info("%d bots played %d games each in %.1fs"
+                            % (args.bots, args.bot_games,
+                               time.perf_counter() - start))
+            else:
+                await tcp.serve_forever()
+    finally:
+        logger.info(server.stats())
+        for task in tasks:
+            task.cancel()
+
+
+if __name__ == "__main__":
+    import torch
+    from NeuralNet import JasonNet
+    from OptimizedNet import INFERENCE_MODES, optimize_for_inference
+
+    parser = ArgumentParser()
+    parser.add_argument("--model", default=None,
+                        help="Checkpoint in model_data to play with, a new "
+                             "net if not given")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--stdio", action="store_true",
+                        help="Play one session on stdin and stdout instead "
+                             "of serving TCP")
+    parser.add_argument("--search_depth", type=int, default=300,
+                        help="Simulations per AI move")
+    parser.add_argument("--search_batch_size", type=int, default=8,
+                        help="Leaves a session sends to the evaluator at "
+                             "once")
+    parser.add_argument("--max_batch", type=int, default=256,
+                        help="Boards that make the evaluator run at once")
+    parser.add_argument("--max_latency_ms", type=float, default=2.0,
+                        help="Longest a board waits for its batch to fill")
+    parser.add_argument("--eval_cache_size", type=int, default=500000,
+                        help="Nbr of net predictions to cache, 0 is off")
+    parser.add_argument("--tablebase", default=None,
+                        help="Endgame tablebase built with Tablebase.py")
+    parser.add_argument("--inference_mode", default="float",
+                        choices=INFERENCE_MODES,
+                        help="Run the net as is, as a TorchScript graph "
+                             "or with int8 Linear layers")
+    parser.add_argument("--report_every", type=float, default=30,
+                        help="Seconds between latency reports")
+    parser.add_argument("--bots", type=int, default=0,
+                        help="Start this many random move clients as a "
+                             "load test and stop when they are done")
+    parser.add_argument("--bot_games", type=int, default=1,
+                        help="Games each bot plays")
+    args = parser.parse_args()
+
+    net = JasonNet()
+    if args.model is not None:
+        net.load_state_dict(torch.load(os.path.join("./model_data/",
+                                                    args.model)))
+    if torch.cuda.is_available():
+        net.cuda()
+    net.eval()
+    asyncio.run(main(args, optimize_for_inference(net, args.inference_mode)))
@@ -1,14 +1,16 @@
 import os
-import torch
-import pickle
-from tqdm import tqdm
 import logging
-import copy
 import numpy as np
-import datetime
-import torch.multiprocessing as mp
 from rules.Mancala import Board
 from Mcts import Tree
+from InferenceServer import run_with_inference_server, split_episodes
+from MonteCarlo import make_training_directory
+from EvalCache import EvalCache
+from SearchStats import SearchStats
+from ReplayStorage import ShardWriter, dataset_directory, save_game_data
+from LazyImport import LazyModule, tqdm
+
+torch = LazyModule("torch")
 
 
 logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
@@ -16,7 +18,11 @@ logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
 logger = logging.getLogger(__file__)
 
 
-def generate_data(net, episodes, depth, iteration):
+def generate_data(net, episodes, depth, iteration, max_nodes=None,
+                  num_processes=1, cache=None, tablebase=None,
+                  stats_path=None, inference_mode="float"):
+    from OptimizedNet import optimize_for_inference
+
     print("Generate data for training")
 
     if torch.cuda.is_available():
@@ -34,29 +40,77 @@ def generate_data(net, episodes, depth, iteration):
         torch.save(net.state_dict(), net_filename)
         logger.info("Saved initial model.")
     
-    self_play(net, episodes, 1.1, iteration, depth)
-
-
-def self_play(net, episodes, temp, iteration, depth):
-    for ind in tqdm(range(episodes)):
+    make_training_directory(iteration)
+    if num_processes > 1:
+        # Workers play the games, one server batches their net calls
+        # and each worker keeps a cache of its own
+        cache_size = cache.max_entries if cache is not None else None
+        worker_args = [(count, 1.1, iteration, depth, max_nodes, start,
+                        cache_size, tablebase, stats_path)
+                       for start, count in
+                       split_episodes(episodes, num_processes)]
+        run_with_inference_server(net, num_processes, self_play_worker,
+                                  worker_args,
+                                  inference_mode=inference_mode)
+    else:
+        # Phase timings and tree sizes of every move, if asked for
+        stats = SearchStats(stats_path) if stats_path else None
+        self_play(optimize_for_inference(net, inference_mode), episodes,
+                  1.1, iteration, depth, max_nodes, cache=cache,
+                  tablebase=tablebase, stats=stats)
+        if stats is not None:
+            stats.end_iteration(iteration)
+        if cache is not None:
+            logger.info("Evaluation cache: {}".format(cache.stats()))
+
+
+def self_play_worker(worker_id, net, num_threads, episodes, temp,
+                     iteration, depth, max_nodes, start_ind, cache_size,
+                     tablebase=None, stats_path=None):
+    torch.set_num_threads(num_threads)
+    logger.info(F"[Worker: {worker_id}]: Playing {episodes} games")
+    cache = EvalCache(cache_size) if cache_size else None
+    stats = SearchStats(stats_path, worker_id) if stats_path else None
+    self_play(net, episodes, temp, iteration, depth, max_nodes, start_ind,
+              cache, tablebase, stats)
+    if stats is not None:
+        stats.end_iteration(iteration)
+    if cache is not None:
+        logger.info(F"[Worker: {worker_id}]: Evaluation cache: "
+                    F"{cache.stats()}")
+
+
+def self_play(net, episodes, temp, iteration, depth, max_nodes=None,
+              start_ind=0, cache=None, tablebase=None, stats=None,
+              writer=None):
+    # Each worker starts at a different game index, use it to name shards.
+    # A writer passed in is left open for the caller's next games
+    own_writer = writer is None
+    if own_writer:
+        writer = ShardWriter(dataset_directory(iteration),
+                             "games%d" % start_ind)
+    for ind in tqdm(range(start_ind, start_ind + episodes)):
         game = Board()  # new game to play with
         is_game_over = False
         replay_buffer = []  # (state, policy, value) for NN training
         value = 0  # winning player. 0 means tie
         move_count = 0  # number of moves so far in the game
+        # One tree per game so the subtree of the played move is reused
+        tree = Tree(net, max_nodes, cache, tablebase, stats)
 
         # While no winner
         while is_game_over is False:
             # Choose best policy after 8 moves.
             t = temp if move_count < 8 else 0.1
-            state_copy = copy.deepcopy(game.current_board)
-            game_copy = copy.deepcopy(game)
+            state_copy = game.current_board[:]
+            game_copy = game.clone()
 
             # In each turn:
             #  Perform a fixed # of MCTS simulations for State at t
             #  pick move by sampling policy(state, reward) from net
-            root = Tree(net)
-            policy = root.think(game_copy, depth, t, show=False)
+            policy = tree.think(game_copy, depth, t, show=False)
+            if stats is not None:
+                stats.end_move()
             legal_moves = game_copy.get_legal_moves()
 
             mv = game_copy.policy_for_legal_moves(legal_moves, policy)
@@ -71,22 +125,8 @@ def self_play(net, episodes, temp, iteration, depth):
                 is_game_over = True
             move_count += 1
 
-        save_game_data(replay_buffer, value, iteration, ind)
-
-
-def save_game_data(replay_buffer, value, itr, ind):
-    dataset = []
-    # replay_buffer is [board_state, policy]
-    for idx, data in enumerate(replay_buffer):
-        state, pol = data
-        dataset.append([state, pol, value])
-    del replay_buffer
-    filename = "iter_%d/" % itr + "dataset_iter%d_%i_%s.pkl" % (
-        itr, ind, datetime.datetime.today().strftime("%Y-%m-%d"))
-    complete_name = os.path.join("./datasets/", filename)
-    save_as_pickle(complete_name, dataset)
-
-
-def save_as_pickle(complete_name, data):
-    with open(complete_name, 'wb') as output:
-        pickle.dump(data, output)
+        if stats is not None:
+            stats.end_game(iteration=iteration, game=ind, winner=value)
+        save_game_data(writer, replay_buffer, value)
+    if own_writer:
+        writer.close()
@@ -0,0 +1,155 @@
+import logging
+import queue
+import time
+
+import numpy as np
+
+from LazyImport import LazyModule
+
+torch = LazyModule("torch")
+mp = LazyModule("torch.multiprocessing")
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+
+class RemoteNet:
+    """ Stand in for JasonNet inside a worker process.
+
+    Calling it sends the boards to the inference server and waits for the
+    policies and values, so the tree searches can use it like the net. """
+
+    def __init__(self, worker_id, request_queue, response_queue):
+        self.worker_id = worker_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+
+    def __call__(self, boards_t):
+        boards = boards_t.detach().cpu().numpy().reshape(-1, 15)
+        self.request_queue.put((self.worker_id, boards))
+        policies, values = self.response_queue.get()
+        return torch.from_numpy(policies), torch.from_numpy(values)
+
+    def eval(self):
+        return self
+
+
+def worker_threads(num_workers):
+    """ Torch threads for the server and each worker so that together
+        they do not use more threads than there are cores """
+    cores = mp.cpu_count()
+    return max(1, cores - num_workers), 1
+
+
+def run_inference_server(state_dict, request_queue, response_queues,
+                         max_batch, batch_timeout, num_threads,
+                         inference_mode="float"):
+    """ Evaluate the boards sent by the workers in batches.
+
+    Waits for a first request, then keeps collecting until every worker
+    is waiting, max_batch boards are queued or batch_timeout seconds have
+    passed, runs one forward pass and sends every worker its rows. Stops
+    on None. """
+    from NeuralNet import JasonNet
+    from OptimizedNet import optimize_for_inference
+
+    torch.set_num_threads(num_threads)
+    net = JasonNet()
+    net.load_state_dict(state_dict)
+    if torch.cuda.is_available():
+        net.cuda()
+    net.eval()
+    net = optimize_for_inference(net, inference_mode)
+
+    batches, evaluated = 0, 0
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        requests = [request]
+        size = len(request[1])
+        deadline = time.time() + batch_timeout
+        # A worker blocks on its request, so at most one is queued each
+        while size < max_batch and len(requests) < len(response_queues):
+            try:
+                request = request_queue.get(
+                    timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                request_queue.put(None)  # handle it after this batch
+                break
+            requests.append(request)
+            size += len(request[1])
+
+        boards = np.concatenate([boards for _, boards in requests])
+        boards_t = torch.tensor(boards, dtype=torch.float32).unsqueeze(1)
+        if torch.cuda.is_available():
+            boards_t = boards_t.cuda()
+        with torch.no_grad():
+            policies, values = net(boards_t)
+        policies = policies.cpu().numpy()
+        values = values.cpu().numpy()
+
+        start = 0
+        for worker_id, worker_boards in requests:
+            end = start + len(worker_boards)
+            response_queues[worker_id].put((policies[start:end],
+                                            values[start:end]))
+            start = end
+        batches += 1
+        evaluated += len(boards)
+
+    logger.info("Inference server evaluated %d boards in %d batches"
+                % (evaluated, batches))
+
+
+def run_with_inference_server(net, num_workers, worker_target, worker_args,
+                              max_batch=1024, batch_timeout=0.001,
+                              inference_mode="float"):
+    """ Start an inference server for net and num_workers processes.
+
+    Each worker is called as worker_target(worker_id, remote_net, num
+    threads, *worker_args[worker_id]) and should use remote_net in place
+    of the net. The server runs net in inference_mode, see
+    OptimizedNet. Returns once every worker has finished. """
+    mp.set_start_method("spawn", force=True)
+    request_queue = mp.Queue()
+    response_queues = [mp.Queue() for _ in range(num_workers)]
+    server_threads, worker_thread_count = worker_threads(num_workers)
+    state_dict = {k: v.cpu() for k, v in net.state_dict().items()}
+
+    server = mp.Process(target=run_inference_server,
+                        args=(state_dict, request_queue, response_queues,
+                              max_batch, batch_timeout,
+                              server_threads, inference_mode))
+    server.start()
+
+    logger.info(F"Spawning {num_workers} workers, {server_threads} "
+                F"inference threads")
+    workers = []
+    for worker_id in range(num_workers):
+        remote_net = RemoteNet(worker_id, request_queue,
+                               response_queues[worker_id])
+        p = mp.Process(target=worker_target,
+                       args=(worker_id, remote_net, worker_thread_count)
+                       + tuple(worker_args[worker_id]))
+        p.start()
+        workers.append(p)
+    for p in workers:
+        p.join()
+
+    request_queue.put(None)
+    server.join()
+
+
+def split_episodes(episodes, num_workers):
+    """ (start index, number of episodes) for each worker """
+    share, extra = divmod(episodes, num_workers)
+    splits, start = [], 0
+    for worker_id in range(num_workers):
+        count = share + (1 if worker_id < extra else 0)
+        splits.append((start, count))
+        start += count
+    return splits
@@ -0,0 +1,24 @@
+import importlib
+
+
+class LazyModule:
+    """ Stand in for a module that is only imported on first use.
+
+    The rules and the searches can then be imported, by the tools and
+    workers that never run a net, without paying for torch. """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+def tqdm(*args, **kwargs):
+    """ tqdm progress bar, imported on first use """
+    from tqdm import tqdm as progress_bar
+    return progress_bar(*args, **kwargs)
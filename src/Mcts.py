@@ -1,9 +1,15 @@
 import numpy as np
-from rules.Mancala import Board
+from collections import OrderedDict
+from rules.Mancala import Board, MIRROR_PITS, canonical_board, \
+    canonical_move
 import time
-import copy
-import torch
-from tqdm import tqdm
+from LazyImport import LazyModule, tqdm
+
+torch = LazyModule("torch")
+
+# Smallest max_nodes a Tree accepts. A search path holds one node per move
+# left in the game and games of random play stay under 100 moves
+MIN_NODES = 128
 
 
 class Node:
@@ -28,103 +34,281 @@ class Node:
 
 
 class Tree:
-    """Monte Carlo Tree"""
+    """Monte Carlo Tree
+
+    Nodes are stored in a transposition table keyed by the canonical
+    Zobrist hash of the board, so a position and its mirror image share a
+    node. When max_nodes is set the least recently used nodes are evicted
+    once the table is full, except for the root of the current think.
+    New states are looked up in the EvalCache, if given, before the net.
+    States below the root that are in the endgame tablebase, if given,
+    return their exact result. The phases of both searches are timed and
+    counted in stats, a SearchStats, if given, like those of
+    MonteCarlo.search."""
 
-    def __init__(self, net):
+    def __init__(self, net, max_nodes=None, cache=None, tablebase=None,
+                 stats=None):
+        if max_nodes is not None and max_nodes < MIN_NODES:
+            raise ValueError("max_nodes must be at least %d to hold a "
+                             "search path" % MIN_NODES)
         self.net = net
-        self.nodes = {}
+        self.max_nodes = max_nodes
+        self.root_key = None  # never evicted
+        self.cache = cache
+        self.tablebase = tablebase
+        self.stats = stats
+        self.nodes = OrderedDict()
+        # Path buffers for search_iterative, doubled when a game is longer
+        self.path_nodes = [None] * 128
+        self.path_actions = [0] * 128
+        self.path_signs = [1] * 128
+
+    def get_node(self, key):
+        """ Look up a node and mark it as recently used """
+        node = self.nodes.get(key)
+        if node is not None:
+            self.nodes.move_to_end(key)
+        return node
+
+    def add_node(self, key, node):
+        self.nodes[key] = node
+        if self.max_nodes is not None and len(self.nodes) > self.max_nodes:
+            if next(iter(self.nodes)) == self.root_key:
+                self.nodes.move_to_end(self.root_key)
+            self.nodes.popitem(last=False)
 
     def search(self, state, depth):
-        # Return predicted value from new state: because it is recursive
-        if state.is_game_over():
-            return state.get_winner()
+        # Return predicted value from new state: because it is recursive.
+        # Values are from the point of view of the player to move in state
+        q_new, node = self.visit(state, depth)
+        if node is None:
+            self.end_select(depth)
+            return q_new
+
+        # State transition by an action selected from bandit
+        player = state.player
+        best_action = self.select_action(node, state, depth)
+
+        # Search next state by recursively calling this function
+        state.process_move(best_action)
+        same_player = state.player == player
+        q_new = self.search(state, depth + 1)
+        # Extra turns keep the sign, otherwise it is the opponent's value
+        if not same_player:
+            q_new = -q_new
+        node.update(canonical_move(best_action, player), q_new)
+
+        if depth == 0 and self.stats is not None:
+            self.stats.lap("backup")
+        return q_new
+
+    def search_iterative(self, state):
+        """ Same simulation as search(state, 0) without recursion. The
+            nodes, actions and sign changes on the way down are kept in
+            preallocated buffers and updated in reverse order once the
+            leaf value is known. """
+        path_nodes, path_actions = self.path_nodes, self.path_actions
+        path_signs = self.path_signs
+        depth = 0
+        while True:
+            q_new, node = self.visit(state, depth)
+            if node is None:
+                break
+
+            player = state.player
+            best_action = self.select_action(node, state, depth)
+            if depth == len(path_nodes):
+                path_nodes.extend([None] * len(path_nodes))
+                path_actions.extend([0] * len(path_actions))
+                path_signs.extend([1] * len(path_signs))
+            path_nodes[depth] = node
+            path_actions[depth] = canonical_move(best_action, player)
+            state.process_move(best_action)
+            path_signs[depth] = 1 if state.player == player else -1
+            depth += 1
+        self.end_select(depth)
+
+        for i in range(depth - 1, -1, -1):
+            q_new *= path_signs[i]
+            path_nodes[i].update(path_actions[i], q_new)
+            path_nodes[i] = None  # do not keep evicted nodes alive
+        if self.stats is not None:
+            self.stats.lap("backup")
+        return q_new
 
-        # Get key for the current state
-        key = state.board_key()
+    def visit(self, state, depth):
+        """ (None, node) of a state to go down from, or (value, None) of a
+            leaf: a finished game, a tablebase position or a new node """
+        if state.is_game_over():
+            if self.stats is not None:
+                self.stats.count("solved")
+            return terminal_value(state), None
+        q_new = self.probe(state, depth)
+        if q_new is not None:
+            return q_new, None
 
-        # if current state is not in the nodes add it and return value
-        if key not in self.nodes:
-            current_board_t_sqzd = board_to_tensor(state.current_board)
+        # Mirror images share a node
+        key = state.canonical_zobrist
+        node = self.get_node(key)
+        if node is None:
+            return self.expand(key, state), None
+        return None, node
 
-            # Use neural net to predict policy and value
-            estimated_policy, estimated_val = self.net(current_board_t_sqzd)
-            # p, v = self.net.predict(state)
+    def end_select(self, depth):
+        """ Book the walk down to a leaf at depth """
+        if self.stats is not None:
+            self.stats.lap("select")
+            self.stats.depth(depth)
 
-            policy_numpy = estimated_policy.detach().cpu().numpy()[0]
-            val = estimated_val.item()
+    def probe(self, state, depth):
+        """ Exact value of a state below the root from the tablebase """
+        if self.tablebase is None or depth == 0:
+            return None
+        solved = self.tablebase.probe(state)
+        if solved is None:
+            return None
+        if self.stats is not None:
+            self.stats.count("solved")
+        return solved[0]
 
-            self.nodes[key] = Node(policy_numpy, val)
+    def expand(self, key, state):
+        """ Evaluate a new state with the net and add it to the tree. The
+            net sees the canonical board, so the policy is over canonical
+            moves and the value is for the player to move """
+        stats = self.stats
+        if stats is not None:
+            stats.lap("select")
+            stats.count("nodes")
+            stats.count("children", len(state.legal_moves))
+        cached = self.cache.lookup(self.net, key) \
+            if self.cache is not None else None
+        if cached is not None:
+            policy_numpy, val = cached
+            self.add_node(key, Node(policy_numpy, val))
+            if stats is not None:
+                stats.count("cache_hits")
+                stats.lap("cache")
             return val
+        if stats is not None:
+            stats.lap("cache")
 
-        # State transition by an action selected from bandit
-        node = self.nodes[key]
+        current_board_t_sqzd = board_to_tensor(
+            canonical_board(state.current_board))
+        if stats is not None:
+            stats.lap("to_tensor")
+
+        # Use neural net to predict policy and value
+        estimated_policy, estimated_val = self.net(current_board_t_sqzd)
+        # p, v = self.net.predict(state)
+
+        policy_numpy = estimated_policy.detach().cpu().numpy()[0]
+        val = estimated_val.item()
+        if stats is not None:
+            stats.lap("forward")
+            stats.count("net_calls")
+            stats.count("net_positions")
+        if self.cache is not None:
+            self.cache.store(self.net, key, policy_numpy, val)
+
+        self.add_node(key, Node(policy_numpy, val))
+        if stats is not None:
+            stats.lap("expand")
+        return val
+
+    @staticmethod
+    def select_action(node, state, depth):
         p = node.p
         if depth == 0:
             # Add noise to policy on the root node
             p = 0.75 * p + 0.25 * np.random.dirichlet([0.15] * len(p))
 
+        player = state.player
         best_action, best_ucb = None, -float('inf')
         # For each legal action find the best choice
-        for action in state.get_legal_moves():
-            n, q_sum = 1 + node.n[action], node.q_sum_all / node.n_all + \
-                       node.q_sum[action]
-            ucb = q_sum / n + 2.0 * np.sqrt(node.n_all) * p[
-                action] / n  # PUCB
+        for action in state.legal_moves:
+            a = canonical_move(action, player)
+            n, q_sum = 1 + node.n[a], node.q_sum_all / node.n_all + \
+                node.q_sum[a]
+            ucb = q_sum / n + 2.0 * np.sqrt(node.n_all) * p[a] / n  # PUCB
 
             if ucb > best_ucb:
                 best_action, best_ucb = action, ucb
+        return best_action
 
-        # Search next state by recursively calling this function
-        state.process_move(best_action)
-        q_new = self.search(state, depth + 1)
-        node.update(best_action, q_new)
-
-        return q_new
+    def root_visits(self, state):
+        """ Visit counts of the moves of state indexed by board pit """
+        n = self.nodes[state.canonical_zobrist].n
+        return n if state.player == 1 else n[MIRROR_PITS]
 
-    def think(self, state, num_simulations, temperature=0, show=False):
+    def think(self, state, num_simulations, temperature=0, show=False,
+              iterative=False):
+        """ Run simulations from state and return the move probabilities.
+            The recursive search is the default, compare_search finds the
+            iterative one no faster """
         start, prev_time = time.time(), 0
+        self.root_key = state.canonical_zobrist
+
+        # Visits left over from searches of earlier moves count towards
+        # the budget when the tree is kept for the whole game
+        root = self.nodes.get(state.canonical_zobrist)
+        previous_visits = root.n_all if root is not None else 0
 
-        for _ in tqdm(range(num_simulations)):
-            state_copy = copy.deepcopy(state)
-            self.search(state_copy, depth=0)
+        for _ in tqdm(range(max(num_simulations - previous_visits, 0))):
+            if self.stats is not None:
+                self.stats.lap()
+                self.stats.count("simulations")
+            state_copy = state.clone()
+            if iterative:
+                self.search_iterative(state_copy)
+            else:
+                self.search(state_copy, depth=0)
 
             # Display search result on every second
             if show:
                 tmp_time = time.time() - start
                 if int(tmp_time) > int(prev_time):
                     prev_time = tmp_time
-                    root, pv = self.nodes[
-                                   state.board_key()], self.pv(state)
+                    root, pv = self.nodes[state.canonical_zobrist], \
+                        self.pv(state)
+                    a = canonical_move(pv[0], state.player)
                     print('%.2f sec. best %s. q = %.4f. n = %d / %d. pv = %s'
                         # % (tmp_time, state.action2str(pv[0]),
                          % (tmp_time, pv[0],
-                         root.q_sum[pv[0]] / root.n[pv[0]],
-                         root.n[pv[0]], root.n_all,
+                         root.q_sum[a] / root.n[a],
+                         root.n[a], root.n_all,
                             #' '.join(
                             pv))
                            #' '.join([state.action2str(a) for a in pv])))
 
         #  Return probability distribution weighted by number of sims
-        n = self.nodes[state.board_key()].n + 1
+        n = self.root_visits(state) + 1
         n = (n / np.max(n)) ** (1 / (temperature + 1e-8))
         return n / n.sum()
 
     def pv(self, state):
         # Return principal variation
         # (action sequence which is considered as the best)
-        s, pv_seq = copy.deepcopy(state), []
+        s, pv_seq = state.clone(), []
         while True:
-            key = s.board_key()
+            key = s.canonical_zobrist
             if key not in self.nodes or self.nodes[key].n.sum() == 0:
                 break
+            visits = self.root_visits(s)
             best_action = sorted(
-                [(a, self.nodes[key].n[a]) for a in s.get_legal_moves()],
+                [(a, visits[a]) for a in s.get_legal_moves()],
                 key=lambda x: -x[1])[0][0]
             pv_seq.append(best_action)
             s.process_move(best_action)
         return pv_seq
 
 
+def terminal_value(state):
+    """ Result of a finished game for the player whose turn it is. The
+        player who made the last move keeps the turn when the game ends """
+    winner = state.get_winner()
+    return winner if state.player == 1 else -winner
+
+
 def board_to_tensor(board):
     if torch.cuda.is_available():
         current_board_t = torch.tensor(board, dtype=torch.float).cuda()
@@ -133,3 +317,39 @@ def board_to_tensor(board):
     # return a new tensor with a 1 dimension added at provided index
     current_board_t_sqzd = current_board_t.unsqueeze(0).unsqueeze(0)
     return current_board_t_sqzd
+
+
+def compare_search(net, num_simulations=1000, seed=0):
+    """ Benchmark the recursive and the iterative search from the opening.
+        Both run on fresh trees with the same random seed, so their trees
+        must come out identical. Returns the simulations per second of
+        each and whether the trees match. """
+    trees, sims_per_sec = {}, {}
+    for name in ("recursive", "iterative"):
+        np.random.seed(seed)
+        tree, state = Tree(net), Board()
+        start = time.time()
+        with torch.no_grad():
+            for _ in range(num_simulations):
+                if name == "iterative":
+                    tree.search_iterative(state.clone())
+                else:
+                    tree.search(state.clone(), depth=0)
+        sims_per_sec[name] = num_simulations / (time.time() - start)
+        trees[name] = tree
+
+    recursive, iterative = trees["recursive"].nodes, trees["iterative"].nodes
+    identical = list(recursive) == list(iterative) and all(
+        np.array_equal(recursive[key].n, iterative[key].n) and
+        np.array_equal(recursive[key].q_sum, iterative[key].q_sum)
+        for key in recursive)
+    return sims_per_sec, identical
+
+
+if __name__ == "__main__":
+    from NeuralNet import JasonNet
+
+    speeds, same_tree = compare_search(JasonNet().eval())
+    print("Recursive: {:.0f} sims/sec, iterative: {:.0f} sims/sec, "
+          "identical trees: {}".format(speeds["recursive"],
+                                       speeds["iterative"], same_tree))
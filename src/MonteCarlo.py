@@ -1,27 +1,29 @@
 import os
-import torch
 import pickle
-from tqdm import tqdm
 import logging
 import copy
 import numpy as np
-import datetime
-import torch.multiprocessing as mp
-from rules.Mancala import Board
+from rules.Mancala import Board, MIRROR_PITS, canonical_board
 from Node import Node
+from InferenceServer import run_with_inference_server, split_episodes
+from EvalCache import EvalCache
+from SearchStats import SearchStats
+from ReplayStorage import ShardWriter, dataset_directory, save_game_data
+from LazyImport import LazyModule, tqdm
+
+# Only the functions that run the net need torch
+torch = LazyModule("torch")
 
 logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
 logger = logging.getLogger(__file__)
 
 
-def run_monte_carlo(net, start_ind, iteration, episodes, depth):
+def run_monte_carlo(net, start_ind, iteration, episodes, depth,
+                    batch_size=1, num_processes=1, cache=None,
+                    stats_path=None, flat_tree=False):
     if torch.cuda.is_available():
         net.cuda()
-
-    logger.info("Prepare network for multi threaded Tree search")
-    mp.set_start_method("spawn", force=True)
-    net.share_memory()
     net.eval()
 
     # Load or save the neural network
@@ -35,28 +37,51 @@ def run_monte_carlo(net, start_ind, iteration, episodes, depth):
         torch.save(net.state_dict(), net_filename)
         logger.info("Saved initial model.")
 
-    # Spawn processes to self play the game
-    processes = []
-    num_processes = 1 # mp.cpu_count()
-
-    logger.info(F"Spawning {num_processes} processes")
-    with torch.no_grad():
-        for i in range(num_processes):
-            p = mp.Process(target=self_play, args=(net, episodes,
-                                                   start_ind, i, 1.1,
-                                                   iteration, depth))
-            p.start()
-            processes.append(p)
-        for p in processes:
-            p.join()
+    if num_processes > 1:
+        # Workers play the games, one server batches their net calls
+        # and each worker keeps a cache of its own
+        cache_size = cache.max_entries if cache is not None else None
+        worker_args = [(count, start_ind + start, 1.1, iteration, depth,
+                        batch_size, cache_size, stats_path, flat_tree)
+                       for start, count in
+                       split_episodes(episodes, num_processes)]
+        run_with_inference_server(net, num_processes, self_play_worker,
+                                  worker_args)
+    else:
+        stats = SearchStats(stats_path) if stats_path else None
+        with torch.no_grad():
+            self_play(net, episodes, start_ind, 0, 1.1, iteration, depth,
+                      batch_size, cache, stats, flat_tree)
+        if stats is not None:
+            stats.end_iteration(iteration)
+        if cache is not None:
+            logger.info("Evaluation cache: {}".format(cache.stats()))
     logger.info("Finished multi-process MCTS!")
 
 
-def self_play(net, episodes, start_ind, core, temp, iteration, depth):
+def self_play_worker(worker_id, net, num_threads, episodes, start_ind,
+                     temp, iteration, depth, batch_size, cache_size,
+                     stats_path=None, flat_tree=False):
+    torch.set_num_threads(num_threads)
+    cache = EvalCache(cache_size) if cache_size else None
+    stats = SearchStats(stats_path, worker_id) if stats_path else None
+    self_play(net, episodes, start_ind, worker_id, temp, iteration, depth,
+              batch_size, cache, stats, flat_tree)
+    if stats is not None:
+        stats.end_iteration(iteration)
+    if cache is not None:
+        logger.info(F"[Core: {worker_id}]: Evaluation cache: "
+                    F"{cache.stats()}")
+
+
+def self_play(net, episodes, start_ind, core, temp, iteration, depth,
+              batch_size=1, cache=None, stats=None, flat_tree=False):
     logger.info("[Core: %d]: Starting MCTS self-play..." % core)
+    run_search, advance = tree_search(flat_tree)
 
     # Make directory for training iteration data to be stored
     make_training_directory(iteration)
+    writer = ShardWriter(dataset_directory(iteration), "core%d" % core)
 
     # tqdm is a progress bar
     for ind in tqdm(range(start_ind, episodes + start_ind)):
@@ -66,6 +91,7 @@ def self_play(net, episodes, start_ind, core, temp, iteration, depth):
         replay_buffer = []  # (state, policy, value) for NN training
         value = 0  # winning player
         move_count = 0  # number of moves so far in the game
+        root = None  # search tree kept between moves
 
         # While no winner and actions you can do
         while is_game_over is False:
@@ -77,7 +103,10 @@ def self_play(net, episodes, start_ind, core, temp, iteration, depth):
             # In each turn:
             #  Perform a fixed # of MCTS simulations for State at t
             #  pick move by sampling policy(state, reward) from net
-            root = search(state_copy, depth, net)
+            root = run_search(game, depth, net, batch_size, root, cache,
+                              stats=stats)
+            if stats is not None:
+                stats.end_move()
             policy = get_policy(root, t)
 
             # Get policy only for legal moves
@@ -89,6 +118,7 @@ def self_play(net, episodes, start_ind, core, temp, iteration, depth):
             # Pick a random choice based off of the probability policy
             move = np.random.choice(legal_moves, p=legal_pol)
             game.process_move(move)
+            root = advance(root, move)
 
             # Add game_state and choice to replay buffer to train NN
             replay_buffer.append([state_copy, policy])
@@ -102,36 +132,251 @@ def self_play(net, episodes, start_ind, core, temp, iteration, depth):
                 is_game_over = True
             move_count += 1
 
-        save_game_data(replay_buffer, value, iteration, core, ind)
+        if stats is not None:
+            stats.end_game(iteration=iteration, game=ind, winner=value)
+        save_game_data(writer, replay_buffer, value)
+    writer.close()
 
 
-def search(game, sim_nbr, net):
-    """ Create tree to find the best policy """
+def tree_search(flat_tree=False):
+    """ The search and advance_root functions of the Node tree, or of the
+        FlatTree which holds the same tree in a few NumPy arrays """
+    if flat_tree:
+        import FlatTree
+        return FlatTree.search, FlatTree.advance_root
+    return search, advance_root
+
+
+def search(game, sim_nbr, net, batch_size=1, root=None, cache=None,
+           tablebase=None, stats=None):
+    """ Create tree to find the best policy
+
+    Leaves are collected batch_size at a time and evaluated with a single
+    forward pass of the net. Virtual loss keeps the leaves of one batch
+    apart; with a batch size of 1 the search is the plain sequential one.
+
+    Passing the root kept by advance_root continues the search from the
+    earlier visits, which count towards sim_nbr. An EvalCache is checked
+    before boards are sent to the net. Leaves found in the endgame
+    tablebase back up their exact result and are not expanded. The time
+    and counts of each phase are added to stats, a SearchStats, if given.
+    """
     # Create root node
-    root = Node(game, move=None, parent=None)
+    if root is None:
+        root = Node(game, move=None, parent=None)
+
+    rounds = search_rounds(root, sim_nbr, batch_size, stats)
+    leaves = next(rounds, None)
+    while leaves is not None:
+        leaves = next_round(rounds, evaluate_leaves(leaves, net, cache,
+                                                    tablebase, stats))
+    return root
+
+
+def search_rounds(root, sim_nbr, batch_size=1, stats=None):
+    """ The rounds of search without the evaluation. Yields the leaves of
+        each round and takes their evaluate_leaves result back through
+        next_round, which expands and backs them up """
+    # Visits of a reused root, the expansion of the root is not stored
+    # in child_number_visits so count it separately
+    simulations = int(root.child_number_visits.sum()) + root.has_children
 
     # For number of simulations find a leaf and evaluate the board with
     # the neural network. if the game is won, backup the winning value
-    for _ in range(sim_nbr):  # number of simulations
+    while simulations < sim_nbr:
+        if stats is not None:
+            stats.lap()
+        leaves = select_leaves(root, round_size(root, batch_size,
+                                                sim_nbr - simulations))
+        if stats is not None:
+            stats.lap("select")
+            for leaf in leaves:
+                stats.depth(node_depth(leaf))
+
+        evaluations = yield leaves
+        new_simulations = backup_leaves(leaves, evaluations, stats)
+        simulations += new_simulations
+        if stats is not None:
+            stats.count("simulations", new_simulations)
+
+
+def next_round(rounds, evaluations):
+    """ Send the evaluations of a round to search_rounds and return the
+        leaves of the next one, None once the search is done """
+    try:
+        return rounds.send(evaluations)
+    except StopIteration:
+        return None
+
+
+def round_size(root, batch_size, remaining):
+    """ Leaves to select in the next round. An unexpanded root is the only
+        leaf there is, so it is expanded on its own first """
+    if not root.has_children:
+        return 1
+    return min(batch_size, remaining)
+
+
+def node_depth(node):
+    depth = 0
+    while node.parent is not None:
+        node = node.parent
+        depth += 1
+    return depth
+
+
+def evaluate_leaves(leaves, net, cache=None, tablebase=None, stats=None):
+    """ Map every leaf whose game is still in progress to its (policy,
+        value), calling the net once for the cache misses. A leaf selected
+        several times is evaluated once.
+
+    The net sees every board from the side of the player to move, so a
+    position and its mirror image share one cache entry. The results are
+    turned back into board pits and a value for player 1 here. Leaves
+    solved by the tablebase get a policy of None and their exact result.
+    The root is always evaluated so that it can be expanded. """
+    evaluations, pending = lookup_leaves(leaves, net, cache, tablebase,
+                                         stats)
+    if pending:
+        policies, values = evaluate_boards(net, canonical_boards(pending),
+                                           stats)
+        store_evaluations(evaluations, pending, policies, values, net,
+                          cache, stats)
+    return evaluations
+
+
+def lookup_leaves(leaves, net, cache=None, tablebase=None, stats=None):
+    """ The evaluations of evaluate_leaves that need no net, and the
+        leaves left for it """
+    evaluations, pending, seen = {}, [], set()
+    for leaf in leaves:
+        if leaf.game.is_game_over() or leaf in seen:
+            continue
+        seen.add(leaf)
+        solved = tablebase.probe_winner(leaf.game) \
+            if tablebase is not None and leaf.parent is not None else None
+        if solved is not None:
+            evaluations[leaf] = (None, solved[0])
+            if stats is not None:
+                stats.count("solved")
+            continue
+        cached = cache.lookup(net, leaf.game.canonical_zobrist) \
+            if cache is not None else None
+        if cached is None:
+            pending.append(leaf)
+        else:
+            evaluations[leaf] = from_canonical(leaf.game, *cached)
+            if stats is not None:
+                stats.count("cache_hits")
+    if stats is not None:
+        stats.lap("cache")
+    return evaluations, pending
+
+
+def canonical_boards(leaves):
+    return [canonical_board(leaf.game.current_board) for leaf in leaves]
+
+
+def store_evaluations(evaluations, pending, policies, values, net,
+                      cache=None, stats=None):
+    """ Add the net outputs for the canonical boards of the pending
+        leaves to evaluations and the cache """
+    for leaf, policy, value in zip(pending, policies, values):
+        evaluations[leaf] = from_canonical(leaf.game, policy, value)
+        if cache is not None:
+            cache.store(net, leaf.game.canonical_zobrist, policy, value)
+    if stats is not None:
+        stats.lap("cache")
+
+
+def from_canonical(game, policy, value):
+    """ Policy over the pits of game and value for player 1 from a net
+        output for the canonical board of game """
+    if game.is_player_1s_turn:
+        return policy, value
+    return policy[MIRROR_PITS], -value
+
+
+def advance_root(root, move):
+    """ Return the subtree reached by playing move, detached from its
+        parent so it can be the root of the next search. Every player has
+        to advance on every move, including the opponent's. Returns None
+        when there is nothing to reuse. """
+    if root is None or move not in root.children:
+        return None
+    child = root.children[move]
+    # The visits of the new root live in its own arrays, the parent only
+    # held its total which a root never uses
+    child.parent = None
+    return child
+
+
+def select_leaves(root, count):
+    """ Select count leaves, adding virtual loss when there is more than
+        one so the selections do not all follow the same path. A leaf can
+        still come up more than once """
+    leaves = []
+    for _ in range(count):
         leaf = root.select_leaf()
-
-        # Convert current_board array to tensor for pytorch
-        current_board_t_sqzd = board_to_tensor(leaf.game.current_board)
-
-        # Use neural net to predict policy and value
-        estimated_policy, estimated_val = net(current_board_t_sqzd)
-        policy_numpy = estimated_policy.detach().cpu().numpy()[0]
-        estimated_val = estimated_val.item()
+        if count > 1:
+            leaf.add_virtual_loss()
+        leaves.append(leaf)
+    return leaves
+
+
+def backup_leaves(leaves, evaluations, stats=None):
+    """ Expand and backup each leaf selected by select_leaves. evaluations
+        maps the leaves whose game is not over to their (policy, value).
+        A leaf selected several times is one simulation, backed up
+        once. Returns the number of simulations """
+    virtual_loss = len(leaves) > 1
+    backed_up = set()
+    for leaf in leaves:
+        if virtual_loss:
+            leaf.revert_virtual_loss()
+        if leaf in backed_up:
+            continue
+        backed_up.add(leaf)
 
         # Check if game over
         if leaf.game.is_game_over() is True:
             # If game is over, backup actual value
             leaf.backup(leaf.game.get_winner())
+            if stats is not None:
+                stats.count("solved")
             continue
 
-        leaf.expand(policy_numpy)  # need to make sure valid moves
-        leaf.backup(estimated_val)
-    return root
+        policy, value = evaluations[leaf]
+        # A solved leaf is final like a finished game
+        if policy is not None:
+            if stats is not None:
+                stats.lap("backup")
+            leaf.expand(policy)  # need to make sure valid moves
+            if stats is not None:
+                stats.lap("expand")
+                stats.count("nodes")
+                stats.count("children", len(leaf.legal_moves))
+        leaf.backup(value)
+    if stats is not None:
+        stats.lap("backup")
+    return len(backed_up)
+
+
+def evaluate_boards(net, boards, stats=None):
+    """ Run the net on a list of boards in one forward pass and return the
+        policies and values as numpy arrays """
+    boards_t = boards_to_tensor(boards)
+    if stats is not None:
+        stats.lap("to_tensor")
+    with torch.no_grad():
+        estimated_policy, estimated_val = net(boards_t)
+    policies = estimated_policy.cpu().numpy()
+    values = estimated_val.view(-1).cpu().numpy()
+    if stats is not None:
+        stats.lap("forward")
+        stats.count("net_calls")
+        stats.count("net_positions", len(boards))
+    return policies, values
 
 
 def board_to_tensor(board):
@@ -144,25 +389,19 @@ def board_to_tensor(board):
     return current_board_t_sqzd
 
 
+def boards_to_tensor(boards):
+    """ Stack boards into a (batch, 1, 15) tensor for the net """
+    boards_t = torch.tensor(boards, dtype=torch.float32)
+    if torch.cuda.is_available():
+        boards_t = boards_t.cuda()
+    return boards_t.unsqueeze(1)
+
+
 def get_policy(root, temp=1):
     return (root.child_number_visits ** (1 / temp)) / \
            sum(root.child_number_visits ** (1 / temp))
 
 
-def save_game_data(replay_buffer, value, itr, core, ind):
-    dataset = []
-    # replay_buffer is [board_state, policy]
-    for idx, data in enumerate(replay_buffer):
-        state, pol = data
-        dataset.append([state, pol, value])
-    del replay_buffer
-    filename = "iter_%d/" % itr + "dataset_iter%d_core%i_%i_%s.pkl" % (
-        itr, core, ind, datetime.datetime.today().strftime
-                       ("%Y-%m-%d"))
-    complete_name = os.path.join("./datasets/", filename)
-    save_as_pickle(complete_name, dataset)
-
-
 def save_as_pickle(complete_name, data):
     with open(complete_name, 'wb') as output:
         pickle.dump(data, output)
@@ -1,13 +1,12 @@
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset
 
 
 class BoardData(Dataset):
-    def __init__(self, dataset):  # dataset is np.array of (s, p, v)
-        self.x_board_state = dataset[:, 0]
-        self.y_policy = dataset[:, 1]
-        self.y_value = dataset[:, 2]
+    def __init__(self, dataset):  # dataset is (boards, policies, values)
+        self.x_board_state, self.y_policy, self.y_value = dataset
 
     def __len__(self):
         return len(self.x_board_state)
@@ -17,11 +16,26 @@ class BoardData(Dataset):
                self.y_policy[idx], \
                self.y_value[idx]
 
+    def tensors(self, device=None):
+        """ The whole dataset as float tensors of shape (n, 1, 15),
+            (n, 14) and (n,) ready to be sliced into mini batches """
+        # Converting reads memory mapped shards straight into the tensors
+        boards = torch.from_numpy(np.asarray(
+            self.x_board_state, dtype=np.float32)).unsqueeze(1)
+        policies = torch.from_numpy(np.asarray(self.y_policy,
+                                               dtype=np.float32))
+        values = torch.from_numpy(np.asarray(self.y_value,
+                                             dtype=np.float32)).view(-1)
+        return boards.to(device), policies.to(device), values.to(device)
+
 
 class JasonNet(torch.nn.Module):
     def __init__(self):
         super(JasonNet, self).__init__()
         self.board_size = 14
+        # Bumped whenever the weights may change so caches of its
+        # predictions know to drop them
+        self.version = 0
 
         # common layers
         self.cnn1d_1 = torch.nn.Conv1d(in_channels=1, out_channels=3,
@@ -38,6 +52,16 @@ class JasonNet(torch.nn.Module):
         self.val_fc2 = nn.Linear(32, 1)
         self.val_fc3 = nn.Linear(1, 1)
 
+    def load_state_dict(self, *args, **kwargs):
+        result = super(JasonNet, self).load_state_dict(*args, **kwargs)
+        self.version += 1
+        return result
+
+    def train(self, mode=True):
+        if mode:
+            self.version += 1
+        return super(JasonNet, self).train(mode)
+
     def forward(self, x):
         x = torch.relu(self.cnn1d_1(x))
         x = torch.relu(self.conv1(x))
@@ -47,7 +71,7 @@ class JasonNet(torch.nn.Module):
         # action policy layers
         x_act = torch.relu(self.act_conv1(x))
         x_act = torch.relu(self.act_fc1(x_act.view(-1, 52)))
-        x_act = torch.log_softmax(x_act, dim=1).exp()
+        x_act = torch.softmax(x_act, dim=1)
 
         # state value layers
         x_val = torch.relu(self.val_conv1(x))
@@ -60,14 +84,14 @@ class JasonNet(torch.nn.Module):
 class AlphaLoss(torch.nn.Module):
     def __init__(self):
         super(AlphaLoss, self).__init__()
-        self.mse_loss_fn = torch.nn.MSELoss(reduction='sum')
 
     def forward(self, y_value, value, y_policy, policy):
-        # Does the below line still throw a warning?
-        value_error = self.mse_loss_fn(y_value[0], value)
+        # y_value and value are (batch,), y_policy and policy (batch, 14).
+        # Squared value error of each sample
+        value_error = (value - y_value.view(-1)) ** 2
 
         # sum of mean-squared error value and cross-entropy policy loss
         policy_error = torch.sum((-policy * (1e-8 + y_policy).log()), 1)
-        ttl_error = (value_error.view(-1).float() + policy_error).mean()
+        ttl_error = (value_error + policy_error).mean()
 
         return ttl_error
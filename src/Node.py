@@ -1,6 +1,16 @@
 import numpy as np
 import math
-import copy
+
+from rules.Mancala import LEGAL_MOVES
+
+# Value taken off a path while its leaf waits for a batched evaluation
+VIRTUAL_LOSS = 1.0
+
+# LEGAL_PITS[player, legal_mask] flags the pits of the legal moves
+LEGAL_PITS = np.zeros((3, 64, 14), dtype=bool)
+for _player in (1, 2):
+    for _mask, _moves in enumerate(LEGAL_MOVES[_player]):
+        LEGAL_PITS[_player, _mask, list(_moves)] = True
 
 
 class Node:
@@ -76,8 +86,8 @@ class Node:
 
         self.legal_moves = legal_moves
         # mask all illegal actions
-        new_policy[[i for i in range(len(policy)) if
-                    i not in legal_moves]] = 0.000000000
+        new_policy[~LEGAL_PITS[self.game.player,
+                               self.game.legal_mask]] = 0.000000000
 
         # add dirichlet noise to child_priors in root node
         if self.parent is not None and self.parent.parent is None:
@@ -89,12 +99,28 @@ class Node:
     def maybe_add_child(self, move):
         if move not in self.children:
             # make a copy of the board
-            copy_board = copy.deepcopy(self.game)
+            copy_board = self.game.clone()
             # take the action on the copied board
             copy_board.process_move(move)
             self.children[move] = Node(copy_board, move, parent=self)
         return self.children[move]
 
+    def add_virtual_loss(self):
+        # Make the path look visited and losing so that other selections
+        # in the same batch spread out to different leaves
+        leaf = self
+        while leaf.parent is not None:
+            leaf.number_visits += 1
+            leaf.total_value -= VIRTUAL_LOSS
+            leaf = leaf.parent
+
+    def revert_virtual_loss(self):
+        leaf = self
+        while leaf.parent is not None:
+            leaf.number_visits -= 1
+            leaf.total_value += VIRTUAL_LOSS
+            leaf = leaf.parent
+
     def backup(self, value_estimate: float):
         # value_estimate is winner or val estimate from neural ne
         leaf = self
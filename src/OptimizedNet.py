@@ -0,0 +1,150 @@
+import copy
+import logging
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+from NeuralNet import JasonNet
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+# float is the plain JasonNet, script a frozen TorchScript graph and
+# quantized the same graph with int8 dynamic quantization of the Linear
+# layers
+INFERENCE_MODES = ("float", "script", "quantized")
+
+# Largest difference from the float net a mode may have on any output
+PARITY_TOLERANCE = {"script": 1e-4, "quantized": 5e-2}
+
+
+class ScriptedNet:
+    """ Inference only stand in for JasonNet around a TorchScript module.
+
+    It has the version of the net it was made from, so EvalCache entries
+    stay tied to those weights. """
+
+    def __init__(self, module, version, mode):
+        self.module = module
+        self.version = version
+        self.mode = mode
+
+    def __call__(self, boards_t):
+        return self.module(boards_t)
+
+    def eval(self):
+        return self
+
+
+def export(net, mode):
+    """ TorchScript module of net for mode, frozen with the inference
+        passes of torch.jit: constant folding, linear weight prepacking and
+        the Conv+ReLU fusions the backend supports """
+    model = copy.deepcopy(net).eval()
+    if mode == "quantized":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        return torch.jit.optimize_for_inference(torch.jit.script(model))
+
+
+def optimize_for_inference(net, mode="float"):
+    """ Net to use for self-play and play in the given mode. Falls back to
+        net itself if the optimized model does not match it """
+    if mode == "float":
+        return net
+    if mode == "quantized" and next(net.parameters()).is_cuda:
+        logger.warning("Quantized inference runs on the CPU only, using "
+                       "the TorchScript net instead")
+        mode = "script"
+    fast_net = ScriptedNet(export(net, mode), net.version, mode)
+    policy_error, value_error = check_parity(net, fast_net)
+    if max(policy_error, value_error) > PARITY_TOLERANCE[mode]:
+        logger.warning("%s net differs from the float net by %.5f policy, "
+                       "%.5f value, using the float net"
+                       % (mode, policy_error, value_error))
+        return net
+    logger.info("Using the %s net, max difference %.5f policy, %.5f value"
+                % (mode, policy_error, value_error))
+    return fast_net
+
+
+def random_boards(samples, seed=0):
+    """ (samples, 1, 15) tensor of random positions for checks """
+    rng = np.random.RandomState(seed)
+    boards = rng.randint(0, 12, (samples, 15))
+    boards[:, 14] = 1
+    return torch.tensor(boards, dtype=torch.float32).unsqueeze(1)
+
+
+def check_parity(net, fast_net, samples=1024):
+    """ Largest absolute policy and value differences of the two nets """
+    boards = random_boards(samples)
+    if next(net.parameters()).is_cuda:
+        boards = boards.cuda()
+    with torch.no_grad():
+        policy, value = net(boards)
+        fast_policy, fast_value = fast_net(boards)
+    return (float((policy - fast_policy).abs().max()),
+            float((value - fast_value).abs().max()))
+
+
+def measure_latency(net, batch_size, repeats=100):
+    """ Median seconds of a forward pass at batch_size """
+    boards = random_boards(batch_size)
+    timings = []
+    with torch.no_grad():
+        for _ in range(5):  # warm up, TorchScript optimizes on first runs
+            net(boards)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            net(boards)
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def compare_modes(net, modes=INFERENCE_MODES,
+                  batch_sizes=(1, 8, 64, 256, 1024), repeats=100):
+    """ Log parity and latency of every mode against the float net and
+        return them as {mode: {"parity": .., "latency_ms": {bs: ..}}} """
+    net = net.eval()
+    results = {}
+    for mode in modes:
+        fast_net = net if mode == "float" else \
+            ScriptedNet(export(net, mode), net.version, mode)
+        latencies = {bs: 1000 * measure_latency(fast_net, bs, repeats)
+                     for bs in batch_sizes}
+        results[mode] = {"parity": check_parity(net, fast_net),
+                         "latency_ms": latencies}
+
+    float_latency = results.get("float", {}).get("latency_ms")
+    for mode, result in results.items():
+        logger.info("%-9s max error policy %.5f value %.5f"
+                    % ((mode,) + result["parity"]))
+        for bs, latency in result["latency_ms"].items():
+            speedup = float_latency[bs] / latency if float_latency else 1
+            logger.info("%-9s batch %4d: %8.3f ms, %9.0f positions/s, "
+                        "%.2fx" % (mode, bs, latency, bs * 1000 / latency,
+                                   speedup))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--model", default=None,
+                        help="Checkpoint in model_data to compare, a new "
+                             "net if not given")
+    parser.add_argument("--repeats", type=int, default=100,
+                        help="Forward passes timed per batch size")
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    jason_net = JasonNet()
+    if args.model is not None:
+        jason_net.load_state_dict(torch.load(
+            os.path.join("./model_data/", args.model)))
+    compare_modes(jason_net, repeats=args.repeats)
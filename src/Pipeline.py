@@ -0,0 +1,204 @@
+import logging
+import os
+import queue
+import time
+
+import torch
+import torch.multiprocessing as mp
+import torch.optim as optim
+
+from Arena import Arena
+from Checkpoint import save_atomic, snapshot
+from EvalCache import EvalCache
+from NeuralNet import JasonNet
+from ReplayStorage import ShardWriter, load_recent
+from Train import train_steps
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+PIPELINE_DATA = "./model_data/pipeline/"
+BEST_PATH = os.path.join(PIPELINE_DATA, "best.pth.tar")
+# Games of the pipeline, kept apart from the iterations of Driver.py
+PIPELINE_DATASETS = "./datasets/pipeline/"
+
+
+def generation_path(generation):
+    return os.path.join(PIPELINE_DATA, "best_gen%d.pth.tar" % generation)
+
+
+def generation_directory(generation):
+    return os.path.join(PIPELINE_DATASETS, "gen_%d" % generation)
+
+
+def load_generations(window):
+    """ The last window positions played by the actors """
+    return load_recent(window, PIPELINE_DATASETS, "gen_")
+
+
+def last_generation():
+    """ Generation of the best net of an earlier run, 0 if none """
+    generation = 0
+    while os.path.isfile(generation_path(generation + 1)):
+        generation += 1
+    return generation
+
+
+def quiet_progress_bars():
+    """ One progress bar per game and per move is noise when several
+        processes play without end """
+    import Generator
+    import Mcts
+    Generator.tqdm = lambda iterable: iterable
+    Mcts.tqdm = lambda iterable: iterable
+
+
+def actor_worker(actor_id, generation, games, stop, depth, max_nodes,
+                 cache_size, tablebase, inference_mode):
+    """ Play self-play games with the best net until stop is set, loading
+        the new best net whenever the generation changes. The games of a
+        generation go to its generation_directory """
+    from Generator import self_play
+    from OptimizedNet import optimize_for_inference
+
+    torch.set_num_threads(1)
+    quiet_progress_bars()
+    cache = EvalCache(cache_size) if cache_size else None
+    net, player, current, writer = JasonNet(), None, None, None
+    while not stop.is_set():
+        if generation.value != current:
+            current = generation.value
+            net.load_state_dict(torch.load(BEST_PATH))
+            net.eval()
+            player = optimize_for_inference(net, inference_mode)
+            if writer is not None:
+                writer.close()
+            writer = ShardWriter(generation_directory(current),
+                                 "actor%d" % actor_id)
+            logger.info("[Actor %d]: Playing with generation %d"
+                        % (actor_id, current))
+        with torch.no_grad():
+            self_play(player, 1, 1.1, current, depth, max_nodes,
+                      cache=cache, tablebase=tablebase, writer=writer)
+        with games.get_lock():
+            games.value += 1
+    if writer is not None:
+        writer.close()
+
+
+def evaluator_worker(candidates, generation, episodes, depth, batch_size,
+                     tablebase, flat_tree, num_threads):
+    """ Battle each checkpoint the learner sends against the best net and
+        promote the winners. Checkpoints that queued up while a battle
+        was running are skipped for the newest. Stops on None, after the
+        last checkpoint sent """
+    torch.set_num_threads(num_threads)
+    best = JasonNet()
+    best.load_state_dict(torch.load(BEST_PATH))
+    best.eval()
+    stopping = False
+    while not stopping:
+        path = candidates.get()
+        if path is None:
+            break
+        while True:
+            try:
+                newer = candidates.get_nowait()
+            except queue.Empty:
+                break
+            if newer is None:
+                # Still battle the last checkpoint before stopping
+                stopping = True
+                break
+            os.remove(path)
+            path = newer
+
+        candidate = JasonNet()
+        candidate.load_state_dict(torch.load(path))
+        candidate.eval()
+        os.remove(path)
+        arena = Arena(best, candidate, tablebase, flat_tree)
+        winner = arena.battle(episodes, depth, batch_size)
+        if winner is candidate:
+            best = candidate
+            save_atomic(snapshot(best.state_dict()), generation_path(
+                generation.value + 1))
+            save_atomic(snapshot(best.state_dict()), BEST_PATH)
+            with generation.get_lock():
+                generation.value += 1
+            logger.info("Promoted %s to generation %d"
+                        % (path, generation.value))
+
+
+def run_pipeline(net, rounds, steps_per_round, window, min_positions,
+                 num_actors, depth, lr, bs, arena_episodes,
+                 batch_size=1, max_nodes=None, cache_size=0,
+                 tablebase=None, flat_tree=False, inference_mode="float",
+                 start_round=0):
+    """ Self-play, training and evaluation running at the same time.
+
+    num_actors processes keep playing games with the best net. The
+    learner, in this process, trains net for steps_per_round mini batches
+    on the last window positions, saves it as a candidate and starts the
+    next round straight away. An evaluator process battles the candidates
+    against the best net and promotes the winners, which the actors pick
+    up before their next game. Stops after rounds learner rounds. """
+    os.makedirs(PIPELINE_DATA, exist_ok=True)
+    if not os.path.isfile(BEST_PATH):
+        save_atomic(snapshot(net.state_dict()), BEST_PATH)
+    else:
+        net.load_state_dict(torch.load(BEST_PATH))
+    if torch.cuda.is_available():
+        net.cuda()
+    net.eval()
+    optimizer = optim.Adam(net.parameters(), lr=lr, betas=(0.8, 0.999),
+                           weight_decay=1e-4)
+
+    # The learner gets the cores the actors and evaluator leave
+    torch.set_num_threads(max(1, mp.cpu_count() - num_actors - 1))
+    ctx = mp.get_context("spawn")
+    generation = ctx.Value("i", last_generation())
+    games = ctx.Value("i", 0)
+    stop, candidates = ctx.Event(), ctx.Queue()
+    actors = [ctx.Process(target=actor_worker,
+                          args=(actor_id, generation, games, stop, depth,
+                                max_nodes, cache_size, tablebase,
+                                inference_mode))
+              for actor_id in range(num_actors)]
+    evaluator = ctx.Process(target=evaluator_worker,
+                            args=(candidates, generation, arena_episodes,
+                                  depth, batch_size, tablebase, flat_tree,
+                                  1))
+    for process in actors + [evaluator]:
+        process.start()
+
+    try:
+        for round_ind in range(start_round, rounds):
+            dataset = load_generations(window)
+            while len(dataset[0]) < min_positions:
+                if not any(actor.is_alive() for actor in actors):
+                    raise RuntimeError("Every self-play actor has stopped")
+                time.sleep(5)
+                dataset = load_generations(window)
+
+            start = time.time()
+            loss = train_steps(net, dataset, optimizer, bs,
+                               steps_per_round)
+            elapsed = time.time() - start
+            path = os.path.join(PIPELINE_DATA,
+                                "candidate_round%d.pth.tar" % round_ind)
+            save_atomic(snapshot(net.state_dict()), path)
+            candidates.put(path)
+            logger.info("Round %d: loss %.4f, %.0f samples/s on %d "
+                        "positions, %d games played, generation %d"
+                        % (round_ind, loss, steps_per_round * bs / elapsed,
+                           len(dataset[0]), games.value, generation.value))
+    finally:
+        stop.set()
+        candidates.put(None)
+        for actor in actors:
+            actor.join()
+        evaluator.join()
+    logger.info("Pipeline finished with generation %d after %d games"
+                % (generation.value, games.value))
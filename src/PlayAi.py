@@ -3,11 +3,13 @@ import os
 import numpy as np
 from NeuralNet import JasonNet
 from rules.Mancala import Board
-from MonteCarlo import search, get_policy
+from MonteCarlo import search, get_policy, advance_root
+from Tablebase import open_tablebase
+from OptimizedNet import INFERENCE_MODES, optimize_for_inference
 from argparse import ArgumentParser
 
 
-def play_match_against_ai(network, depth):
+def play_match_against_ai(network, depth, batch_size=1, tablebase=None):
     net_is_player1 = np.random.uniform(0, 1) <= 0.5
     if net_is_player1:
         print("You are player 2!")
@@ -18,6 +20,7 @@ def play_match_against_ai(network, depth):
     game.is_printing = True
     game_over = False
     moves_count = 0
+    root = None  # search tree kept between moves
 
     while game_over is False:
         # set exploration factor
@@ -26,11 +29,14 @@ def play_match_against_ai(network, depth):
 
         game.print_current_board()
         # Get move from player or ai depending on whose turn it is
-        move = process_ai_move(game, depth, network, temp) \
-            if net_is_player1 == (game.player == 1) \
-            else get_move_from_player()
+        if net_is_player1 == (game.player == 1):
+            move, root = process_ai_move(game, depth, network, temp,
+                                         batch_size, root, tablebase)
+        else:
+            move = get_move_from_player()
 
         game.process_move(move)
+        root = advance_root(root, move)
 
         if game.is_game_over():
             game_over = True
@@ -49,11 +55,17 @@ def get_move_from_player():
             print("That's not an int! Try again.")
 
 
-def process_ai_move(game, depth, net, temp):
+def process_ai_move(game, depth, net, temp, batch_size=1, root=None,
+                    tablebase=None):
+    solved = tablebase.probe(game) if tablebase is not None else None
+    if solved is not None:
+        print("AI knows how this ends!")
+        return solved[1], root
+
     print("AI is thinking...")
     # turn off printing for AI's thinking
     game.is_printing = False
-    root = search(game, depth, net)
+    root = search(game, depth, net, batch_size, root, tablebase=tablebase)
     policy = get_policy(root, temp)
     # turn printing back on
     game.is_printing = True
@@ -61,7 +73,7 @@ def process_ai_move(game, depth, net, temp):
     legal_moves = game.get_legal_moves()
     policy = game.policy_for_legal_moves(legal_moves, policy)
     move = np.random.choice(legal_moves, p=policy)
-    return move
+    return move, root
 
 
 if __name__ == "__main__":
@@ -70,6 +82,14 @@ if __name__ == "__main__":
                         help="Model pickle you wish to play against")
     parser.add_argument("--search_depth", type=int, default=300,
                         help="How deep in tree to search")
+    parser.add_argument("--search_batch_size", type=int, default=1,
+                        help="Nbr of leaves evaluated together in search")
+    parser.add_argument("--tablebase", default=None,
+                        help="Endgame tablebase built with Tablebase.py")
+    parser.add_argument("--inference_mode", default="float",
+                        choices=INFERENCE_MODES,
+                        help="Run the net as is, as a TorchScript graph "
+                             "or with int8 Linear layers")
     args = parser.parse_args()
 
     best_net = args.model
@@ -81,10 +101,14 @@ if __name__ == "__main__":
     net.eval()
     checkpoint = torch.load(best_net_filename)
     net.load_state_dict(checkpoint)
+    net = optimize_for_inference(net, args.inference_mode)
+
+    tablebase = open_tablebase(args.tablebase)
 
     play_again = True
     while play_again:
-        board = play_match_against_ai(net, args.search_depth)
+        board = play_match_against_ai(net, args.search_depth,
+                                      args.search_batch_size, tablebase)
         winner = board.get_winner()
         print(F"Winner is: {board.get_winner_string()}")
         while True:
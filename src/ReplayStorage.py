@@ -0,0 +1,349 @@
+import logging
+import os
+import pickle
+from argparse import ArgumentParser
+
+import numpy as np
+
+from rules.Mancala import MIRROR_PITS
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+# One file per column, rows are appended as raw fixed width records
+COLUMNS = {"boards": (np.int8, 15),
+           "policies": (np.float16, 14),
+           "values": (np.int8, 1)}
+
+
+def dataset_directory(iteration):
+    return "./datasets/iter_%d/" % iteration
+
+
+def shard_path(directory, stem, column):
+    return os.path.join(directory, "%s.%s" % (stem, column))
+
+
+def canonical_game(boards, policies, winner):
+    """ Rows of a game as seen by the player to move. Positions of player
+        2 are mirrored onto player 1's side of the board with their policy,
+        and every value is the result for the player to move, so each
+        position also teaches the net the mirrored one """
+    boards = np.array(boards, dtype=np.int8)
+    policies = np.array(policies, dtype=np.float32)
+    player_2 = boards[:, 14] == 2
+    boards[player_2] = np.concatenate(
+        [boards[player_2][:, 7:14], boards[player_2][:, :7],
+         np.ones((player_2.sum(), 1), dtype=np.int8)], axis=1)
+    policies[player_2] = policies[player_2][:, MIRROR_PITS]
+    values = np.where(player_2, -winner, winner)
+    return boards, policies, values
+
+
+def save_game_data(writer, replay_buffer, value):
+    """ Append a game of self-play to writer, a ShardWriter. replay_buffer
+        holds [board_state, policy] per move and value is the winner """
+    writer.append_game(*canonical_game(
+        [state for state, _ in replay_buffer],
+        [policy for _, policy in replay_buffer], value))
+
+
+class ShardWriter:
+    """ Appends self-play positions to the shards of one writer.
+
+    A shard is a set of files named <name>_<number>.<column>, one per
+    column of COLUMNS, holding fixed width binary rows that can be memory
+    mapped. Each process writes under its own name so writers never
+    share a file. A new shard is started after max_positions rows. """
+
+    def __init__(self, directory, name, max_positions=1 << 16):
+        self.directory = directory
+        self.name = name
+        self.max_positions = max_positions
+        self.shard = 0
+        self.positions = 0
+        self.files = None
+        os.makedirs(directory, exist_ok=True)
+        # Continue after the shards left by an earlier run
+        while os.path.isfile(shard_path(directory, self.stem(), "boards")):
+            self.shard += 1
+
+    def stem(self):
+        return "%s_%05d" % (self.name, self.shard)
+
+    def open_shard(self):
+        self.files = {column: open(shard_path(self.directory, self.stem(),
+                                              column), "ab")
+                      for column in COLUMNS}
+        self.positions = 0
+
+    def append_game(self, boards, policies, values):
+        """ Append every position of a game. boards and policies hold one
+            row per move, values holds the result of every row or one
+            result for the whole game """
+        if self.files is None or self.positions >= self.max_positions:
+            self.close()
+            self.open_shard()
+        rows = {"boards": np.asarray(boards, dtype=np.int8),
+                "policies": np.asarray(policies, dtype=np.float16),
+                "values": np.broadcast_to(
+                    np.asarray(values, dtype=np.int8), (len(boards),))}
+        for column, data in rows.items():
+            self.files[column].write(data.tobytes())
+            self.files[column].flush()
+        self.positions += len(boards)
+
+    def close(self):
+        if self.files is not None:
+            for f in self.files.values():
+                f.close()
+            self.files = None
+            self.shard += 1
+
+
+def open_shard(directory, stem):
+    """ Memory map the columns of one shard. A shard cut short by a crash
+        is trimmed to the rows present in every column """
+    sizes = {}
+    for column, (dtype, width) in COLUMNS.items():
+        row_bytes = np.dtype(dtype).itemsize * width
+        sizes[column] = os.path.getsize(
+            shard_path(directory, stem, column)) // row_bytes
+    rows = min(sizes.values())
+    shard = {}
+    for column, (dtype, width) in COLUMNS.items():
+        if rows == 0:
+            shard[column] = np.zeros((0, width), dtype=dtype)
+        else:
+            shard[column] = np.memmap(shard_path(directory, stem, column),
+                                      dtype=dtype, mode="r",
+                                      shape=(rows, width))
+    return shard
+
+
+def list_shards(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(file[:-len(".boards")] for file in os.listdir(directory)
+                  if file.endswith(".boards"))
+
+
+def join_datasets(datasets):
+    """ The rows of several (boards, policies, values) one after the other.
+        A single dataset is returned as it is, so the columns of a lone
+        shard stay memory mapped instead of being copied """
+    if len(datasets) == 1:
+        return datasets[0]
+    return tuple(np.concatenate([dataset[column] for dataset in datasets])
+                 for column in range(3))
+
+
+def load_dataset(directory):
+    """ Boards, policies and values of every shard in directory """
+    shards = [open_shard(directory, stem) for stem in list_shards(directory)]
+    if not shards:
+        return np.zeros((0, 15), dtype=np.int8), \
+            np.zeros((0, 14), dtype=np.float16), np.zeros(0, dtype=np.int8)
+    return join_datasets([(shard["boards"], shard["policies"],
+                           shard["values"][:, 0]) for shard in shards])
+
+
+def dataset_iterations(root="./datasets/", prefix="iter_"):
+    """ Iterations with a dataset directory <prefix><iteration> under
+        root, oldest first """
+    if not os.path.isdir(root):
+        return []
+    return sorted(int(name[len(prefix):]) for name in os.listdir(root)
+                  if name.startswith(prefix) and
+                  name[len(prefix):].isdigit())
+
+
+def load_recent(window, root="./datasets/", prefix="iter_"):
+    """ The last window positions over the newest dataset directories """
+    parts, total = [], 0
+    for iteration in reversed(dataset_iterations(root, prefix)):
+        dataset = load_dataset(os.path.join(root, "%s%d"
+                                            % (prefix, iteration)))
+        if len(dataset[0]):
+            parts.insert(0, dataset)
+            total += len(dataset[0])
+        if total >= window:
+            break
+    if not parts:
+        return load_dataset(root)
+    return tuple(column[-window:] for column in join_datasets(parts))
+
+
+class ReplayBuffer:
+    """ Positions of the last window iterations in preallocated arrays.
+
+    Rows are appended to a ring of capacity rows, overwriting the oldest
+    when full, and the rows of an iteration stay contiguous in the ring.
+    segments holds [iteration, first row, rows] per iteration, oldest
+    first. Adding an iteration drops those more than window iterations
+    older. snapshot writes the rows to one .npz file that restore loads
+    without going through the shards. """
+
+    def __init__(self, capacity=1 << 19, window=5):
+        self.capacity = capacity
+        self.window = window
+        self.columns = [np.zeros((capacity,) + ((width,) if width > 1
+                                                 else ()), dtype=dtype)
+                        for dtype, width in COLUMNS.values()]
+        self.segments = []
+        self.head = 0  # row the next position goes to
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def iterations(self):
+        return [iteration for iteration, _, _ in self.segments]
+
+    def append(self, boards, policies, values, iteration):
+        """ Add positions of iteration, the newest one held so far """
+        if self.segments and iteration < self.segments[-1][0]:
+            raise ValueError("Iteration %d is older than %d"
+                             % (iteration, self.segments[-1][0]))
+        if not self.segments or iteration > self.segments[-1][0]:
+            self.segments.append([iteration, self.head, 0])
+            # The rows before head - size are free, no need to clear them
+            while self.segments[0][0] <= iteration - self.window:
+                self.size -= self.segments.pop(0)[2]
+
+        rows = len(boards)
+        if rows > self.capacity:  # only the newest fit
+            boards, policies, values = \
+                boards[-self.capacity:], policies[-self.capacity:], \
+                values[-self.capacity:]
+            rows = self.capacity
+        if self.size + rows > self.capacity:
+            self.drop_oldest(self.size + rows - self.capacity)
+        end = self.head + rows
+        for column, data in zip(self.columns, (boards, policies, values)):
+            if end <= self.capacity:
+                column[self.head:end] = data
+            else:
+                split = self.capacity - self.head
+                column[self.head:] = data[:split]
+                column[:end - self.capacity] = data[split:]
+        self.head = end % self.capacity
+        self.size += rows
+        self.segments[-1][2] += rows
+
+    def drop_oldest(self, rows):
+        """ Forget the rows oldest first, emptied segments are removed """
+        while rows > 0:
+            segment = self.segments[0]
+            dropped = min(rows, segment[2])
+            segment[1] = (segment[1] + dropped) % self.capacity
+            segment[2] -= dropped
+            self.size -= dropped
+            rows -= dropped
+            if segment[2] == 0 and len(self.segments) > 1:
+                self.segments.pop(0)
+
+    def rows(self):
+        """ Ring indices of every position, oldest first """
+        start = (self.head - self.size) % self.capacity
+        return (start + np.arange(self.size)) % self.capacity
+
+    def dataset(self):
+        """ (boards, policies, values) of every position, oldest first """
+        rows = self.rows()
+        return tuple(column[rows] for column in self.columns)
+
+    def sample(self, samples, recency=1.0, rng=np.random):
+        """ (boards, policies, values) of samples positions drawn with
+            replacement. A position k iterations older than the newest is
+            recency ** k times as likely as a newest one, 1 is uniform """
+        segments = [segment for segment in self.segments if segment[2]]
+        newest = segments[-1][0]
+        mass = np.array([rows * recency ** (newest - iteration)
+                         for iteration, _, rows in segments])
+        picked = rng.choice(len(segments), samples, p=mass / mass.sum())
+        starts = np.array([start for _, start, _ in segments])[picked]
+        counts = np.array([rows for _, _, rows in segments])[picked]
+        rows = (starts + (rng.random_sample(samples) * counts)
+                .astype(np.int64)) % self.capacity
+        return tuple(column[rows] for column in self.columns)
+
+    def load_iterations(self, iterations):
+        """ Append the shards of the iterations not held yet """
+        for iteration in iterations:
+            if iteration in self.iterations() or \
+                    (self.segments and iteration < self.segments[-1][0]):
+                continue
+            dataset = load_dataset(dataset_directory(iteration))
+            if len(dataset[0]):
+                self.append(*dataset, iteration)
+                logger.info("Replay buffer: %d positions of iteration %d"
+                            % (len(dataset[0]), iteration))
+
+    def snapshot(self, path):
+        boards, policies, values = self.dataset()
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, boards=boards, policies=policies, values=values,
+                 segments=np.array([[iteration, rows] for iteration, _, rows
+                                    in self.segments], dtype=np.int64)
+                 .reshape(-1, 2),
+                 config=np.array([self.capacity, self.window]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def restore(cls, path, capacity=None, window=None):
+        """ Buffer saved by snapshot, capacity and window default to the
+            saved ones """
+        with np.load(path) as saved:
+            saved_capacity, saved_window = saved["config"]
+            buffer = cls(capacity or int(saved_capacity),
+                         window or int(saved_window))
+            start = 0
+            for iteration, rows in saved["segments"]:
+                end = start + int(rows)
+                buffer.append(saved["boards"][start:end],
+                              saved["policies"][start:end],
+                              saved["values"][start:end], int(iteration))
+                start = end
+        return buffer
+
+
+def list_pickles(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(f for f in os.listdir(directory) if f.endswith(".pkl"))
+
+
+def convert_pickle_dataset(directory, remove=False):
+    """ Write the games of the old one pickle per game files in directory
+        to shards. Returns the number of games converted """
+    files = list_pickles(directory)
+    if not files:
+        return 0
+    writer = ShardWriter(directory, "converted")
+    for file in files:
+        filename = os.path.join(directory, file)
+        with open(filename, "rb") as fo:
+            game = pickle.load(fo, encoding="bytes")
+        if game:
+            # Old games hold raw boards and the winner for player 1
+            writer.append_game(*canonical_game(
+                [state for state, _, _ in game],
+                [policy for _, policy, _ in game], game[0][2]))
+        if remove:
+            os.remove(filename)
+    writer.close()
+    logger.info("Converted %d pickled games in %s" % (len(files), directory))
+    return len(files)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("directories", nargs="+",
+                        help="Dataset directories such as datasets/iter_0")
+    parser.add_argument("--remove", action="store_true",
+                        help="Delete the pickles once converted")
+    args = parser.parse_args()
+    for data_dir in args.directories:
+        convert_pickle_dataset(data_dir, args.remove)
@@ -0,0 +1,40 @@
+import datetime
+import logging
+import os
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+
+def plot_losses(losses_per_epoch, iteration, directory="./model_data/",
+                show=False):
+    """ Save the loss per epoch of a training run as a PNG and return its
+        path.
+
+    matplotlib is only imported here and uses the Agg backend, which
+    needs no display, unless show is set. Without matplotlib the plot is
+    skipped and None returned. """
+    try:
+        import matplotlib
+    except ImportError:
+        logger.warning("matplotlib is not installed, skipping the plot")
+        return None
+    if not show:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure()
+    ax = fig.add_subplot(222)
+    ax.scatter([e for e in range(len(losses_per_epoch))],
+               losses_per_epoch)
+    ax.set_xlabel("Epoch")
+    ax.set_ylabel("Loss per batch")
+    ax.set_title("Loss vs Epoch")
+    path = os.path.join(directory, "Loss_vs_Epoch_iter%d_%s.png" % (
+        iteration, datetime.datetime.today().strftime("%Y-%m-%d")))
+    plt.savefig(path)
+    if show:
+        plt.show()
+    plt.close(fig)
+    return path
@@ -0,0 +1,107 @@
+import json
+import os
+import time
+from collections import defaultdict
+
+
+class SearchStats:
+    """ Timers and counters for the phases of a tree search.
+
+    The searches take an optional stats object and only touch it when one
+    is given, so there is no cost when profiling is off. lap(phase) books
+    the time since the previous lap to phase; lap() only restarts the
+    clock. Counters are added with count and the deepest leaf with
+    depth. end_move, end_game and end_iteration roll the numbers up and
+    the last two append a JSON line to path, if given.
+
+    Phases: select (walking down the tree, including creating and cloning
+    the boards of new nodes), cache, to_tensor, forward, expand and
+    backup. Counters: simulations, nodes (nodes created), children (legal
+    moves of the created nodes), net_calls, net_positions, cache_hits and
+    solved (terminal or tablebase leaves). """
+
+    def __init__(self, path=None, worker=None):
+        self.path = path
+        self.worker = worker
+        self.last = time.perf_counter()
+        self.move = self.new_totals()
+        self.game = self.new_totals()
+        self.iteration = self.new_totals()
+        self.games = 0
+        if path is not None and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @staticmethod
+    def new_totals():
+        return {"times": defaultdict(float), "counts": defaultdict(int),
+                "max_depth": 0, "moves": 0}
+
+    def lap(self, phase=None):
+        now = time.perf_counter()
+        if phase is not None:
+            self.move["times"][phase] += now - self.last
+        self.last = now
+
+    def count(self, name, amount=1):
+        self.move["counts"][name] += amount
+
+    def depth(self, depth):
+        if depth > self.move["max_depth"]:
+            self.move["max_depth"] = depth
+
+    def end_move(self):
+        """ Add the current move to the game and return its numbers """
+        self.move["moves"] = 1
+        move = self.move
+        self.add(self.game, move)
+        self.move = self.new_totals()
+        return move
+
+    def end_game(self, **info):
+        """ Add the game to the iteration and write its summary """
+        self.add(self.iteration, self.game)
+        self.games += 1
+        record = self.summary(self.game, record="game", **info)
+        self.game = self.new_totals()
+        self.write(record)
+        return record
+
+    def end_iteration(self, iteration, **info):
+        record = self.summary(self.iteration, record="iteration",
+                              iteration=iteration, games=self.games, **info)
+        self.iteration = self.new_totals()
+        self.games = 0
+        self.write(record)
+        return record
+
+    @staticmethod
+    def add(totals, other):
+        for phase, seconds in other["times"].items():
+            totals["times"][phase] += seconds
+        for name, amount in other["counts"].items():
+            totals["counts"][name] += amount
+        totals["max_depth"] = max(totals["max_depth"], other["max_depth"])
+        totals["moves"] += other["moves"]
+
+    def summary(self, totals, **info):
+        counts = totals["counts"]
+        moves = max(totals["moves"], 1)
+        record = dict(info)
+        if self.worker is not None:
+            record["worker"] = self.worker
+        record.update({
+            "moves": totals["moves"],
+            "seconds": dict(totals["times"]),
+            "counts": dict(counts),
+            "max_depth": totals["max_depth"],
+            "branching": counts["children"] / max(counts["nodes"], 1),
+            "nodes_per_move": counts["nodes"] / moves,
+            "net_calls_per_move": counts["net_calls"] / moves,
+            "simulations_per_move": counts["simulations"] / moves})
+        return record
+
+    def write(self, record):
+        if self.path is None:
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
@@ -0,0 +1,304 @@
+import logging
+import os
+import struct
+import time
+from argparse import ArgumentParser
+from math import comb
+
+import numpy as np
+
+from rules.Mancala import Board, canonical_board, canonical_move
+from rules.BatchMancala import BatchBoard
+
+logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
+                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+DEFAULT_PATH = "./model_data/endgame.tb"
+MAGIC = b"MNCL"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+
+# Distance of each of the 12 playing pits to the home its marbles are
+# sown into first. Every move either puts a marble in a home or lowers
+# the sum of the distances of the marbles in play, so positions can be
+# solved in order of (marbles in play, potential) without any cycles.
+DISTANCE = np.array([6, 5, 4, 3, 2, 1] * 2, dtype=np.int64)
+
+# Most marbles in play a tablebase can hold, the margins fit an int8.
+# Games are solved to the end without the early win rule: a capture can
+# take a home past 24 first, but a home holding more than half of the 48
+# marbles wins the full game too, so the sign of the solved margin, all
+# that probe returns, is the result the rule gives
+MAX_SEEDS = 24
+
+
+def compositions_count(total, parts):
+    """ Number of ways to put total marbles in parts pits """
+    if parts == 0:
+        return 1 if total == 0 else 0
+    return comb(total + parts - 1, parts - 1)
+
+
+def build_rank_tables(max_seeds):
+    """ offsets[s] is the index of the first position with s marbles in
+        play and skip[m][r][c] the number of positions placed before one
+        whose next pit holds c of the r marbles left for its last m pits """
+    offsets = [0]
+    for seeds in range(max_seeds + 1):
+        offsets.append(offsets[-1] + compositions_count(seeds, 12))
+    skip = np.zeros((13, max_seeds + 1, max_seeds + 1), dtype=np.int64)
+    for parts in range(1, 13):
+        for left in range(max_seeds + 1):
+            for count in range(1, left + 1):
+                skip[parts, left, count] = skip[parts, left, count - 1] + \
+                    compositions_count(left - count + 1, parts - 1)
+    return offsets, skip
+
+
+def compositions(total, parts=12):
+    """ Every way to put total marbles in parts pits, one row each, in the
+        order used by the index """
+    rows = np.zeros((1, 0), dtype=np.int16)
+    left = np.array([total], dtype=np.int64)
+    for _ in range(parts - 1):
+        repeats = left + 1
+        starts = np.repeat(np.cumsum(repeats) - repeats, repeats)
+        counts = np.arange(repeats.sum()) - starts
+        rows = np.concatenate([np.repeat(rows, repeats, axis=0),
+                               counts[:, None].astype(np.int16)], axis=1)
+        left = np.repeat(left, repeats) - counts
+    return np.concatenate([rows, left[:, None].astype(np.int16)], axis=1)
+
+
+def position_indices(pits, offsets, skip):
+    """ Index of each row of 12 canonical pit counts """
+    pits = pits.astype(np.int64)
+    left = pits.sum(axis=1)
+    indices = np.asarray(offsets)[left]
+    for pit in range(12):
+        indices += skip[12 - pit, left, pits[:, pit]]
+        left -= pits[:, pit]
+    return indices
+
+
+def build_tablebase(max_seeds):
+    """ Solve every position with at most max_seeds marbles in play.
+
+    Positions are seen by the player to move and only the 12 playing pits
+    count: the marbles already home can not change hands, so the value of
+    a position is the best margin the player to move can still add to
+    their home against the other player's, with perfect play from both.
+    Returns (values, moves) indexed like position_indices, moves holding
+    the canonical pit of a best move or -1 if the game is over. """
+    if max_seeds > MAX_SEEDS:
+        raise ValueError("At most %d marbles in play" % MAX_SEEDS)
+    offsets, skip = build_rank_tables(max_seeds)
+    values = np.zeros(offsets[-1], dtype=np.int8)
+    moves = np.full(offsets[-1], -1, dtype=np.int8)
+
+    for seeds in range(max_seeds + 1):
+        pits = compositions(seeds)
+        first = offsets[seeds]
+        own, other = pits[:, :6].sum(axis=1), pits[:, 6:].sum(axis=1)
+
+        # With one side empty the game is over and the marbles left go
+        # to the home of their side
+        over = (own == 0) | (other == 0)
+        values[first + np.flatnonzero(over)] = (own - other)[over]
+
+        potential = pits.astype(np.int64) @ DISTANCE
+        for level in np.unique(potential[~over]):
+            rows = np.flatnonzero(~over & (potential == level))
+            best = np.full(len(rows), -128, dtype=np.int64)
+            best_move = np.full(len(rows), -1, dtype=np.int64)
+            for move in range(6):
+                legal = pits[rows, move] > 0
+                margin = move_margins(pits[rows[legal]], move, values,
+                                      offsets, skip)
+                better = np.zeros(len(rows), dtype=bool)
+                better[legal] = margin > best[legal]
+                best[better] = margin[better[legal]]
+                best_move[better] = move
+            values[first + rows] = best
+            moves[first + rows] = best_move
+        logger.debug("Solved %d positions with %d marbles" % (len(pits),
+                                                              seeds))
+    return values, moves
+
+
+def move_margins(pits, move, values, offsets, skip):
+    """ Margin for the player to move of playing move in each position,
+        using the values of the positions it leads to """
+    batch = BatchBoard(len(pits))
+    batch.boards[:] = 0
+    batch.boards[:, :6] = pits[:, :6]
+    batch.boards[:, 7:13] = pits[:, 6:]
+    batch.boards[:, 14] = 1
+    batch.process_moves(np.full(len(pits), move))
+    boards = batch.boards
+
+    margin = boards[:, 6].astype(np.int64) - boards[:, 13]
+    playing = ~batch.game_over
+    extra_turn = boards[:, 14] == 1
+    # The next position as seen by whoever moves next
+    child = np.where(extra_turn[:, None],
+                     np.concatenate([boards[:, :6], boards[:, 7:13]], 1),
+                     np.concatenate([boards[:, 7:13], boards[:, :6]], 1))
+    child_values = values[position_indices(
+        child[playing], offsets, skip)].astype(np.int64)
+    margin[playing] += np.where(extra_turn[playing], child_values,
+                                -child_values)
+    return margin
+
+
+def write_tablebase(path, max_seeds, values, moves):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, max_seeds))
+        f.write(values.tobytes())
+        f.write(moves.tobytes())
+
+
+class Tablebase:
+    """ Exact endgame results read from a file made by build_tablebase.
+
+    The file is memory mapped, so only the pages that are probed are
+    read and processes share them through the page cache. """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, self.max_seeds = HEADER.unpack(
+                f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d tablebase"
+                             % (path, VERSION))
+        offsets, skip = build_rank_tables(self.max_seeds)
+        self.offsets = offsets
+        self.skip = skip.tolist()
+        size = offsets[-1]
+        self.values = np.memmap(path, dtype=np.int8, mode="r",
+                                offset=HEADER.size, shape=(size,))
+        self.moves = np.memmap(path, dtype=np.int8, mode="r",
+                               offset=HEADER.size + size, shape=(size,))
+        self.hits = 0
+
+    def __getstate__(self):
+        # Worker processes map the file again instead of copying it
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def index(self, board):
+        """ Index of a Board, None if too many marbles are in play """
+        left = board.side_1_total + board.side_2_total
+        if left > self.max_seeds:
+            return None
+        pits = canonical_board(board.current_board)
+        index = self.offsets[left]
+        for pit in range(12):
+            count = pits[pit if pit < 6 else pit + 1]
+            index += self.skip[12 - pit][left][count]
+            left -= count
+        return index
+
+    def probe(self, board):
+        """ (result, move) for the player to move with perfect play, the
+            result being 1 for a win, -1 for a loss and 0 for a tie and
+            move the pit of a best move. None if board is not covered """
+        if board.game_over:
+            return None
+        index = self.index(board)
+        if index is None:
+            return None
+        self.hits += 1
+        home, other_home = (6, 13) if board.is_player_1s_turn else (13, 6)
+        margin = int(self.values[index]) + \
+            board.current_board[home] - board.current_board[other_home]
+        move = canonical_move(int(self.moves[index]), board.player)
+        return (margin > 0) - (margin < 0), move
+
+    def probe_winner(self, board):
+        """ Like probe, with the result for player 1 as from get_winner """
+        entry = self.probe(board)
+        if entry is None:
+            return None
+        result, move = entry
+        return (result if board.is_player_1s_turn else -result), move
+
+
+def open_tablebase(path):
+    """ The tablebase at path, or None when there is no path or file """
+    if not path:
+        return None
+    if not os.path.isfile(path):
+        logger.warning("No endgame tablebase at %s" % path)
+        return None
+    return Tablebase(path)
+
+
+def solve(board):
+    """ Best margin the player to move can still add, by a full search of
+        the game with Board. Only practical with very few marbles """
+    if board.game_over:
+        return 0
+    home, other_home = (6, 13) if board.is_player_1s_turn else (13, 6)
+    best = None
+    for move in board.legal_moves:
+        child = board.clone()
+        child.process_move(move)
+        margin = child.current_board[home] - board.current_board[home] - \
+            (child.current_board[other_home] - board.current_board[
+                other_home])
+        if not child.game_over:
+            value = solve(child)
+            margin += value if child.player == board.player else -value
+        best = margin if best is None else max(best, margin)
+    return best
+
+
+def check_tablebase(tablebase, positions=200, max_seeds=7, seed=0):
+    """ Compare the tablebase with a full search on random positions """
+    rng = np.random.RandomState(seed)
+    max_seeds = min(max_seeds, tablebase.max_seeds)
+    for _ in range(positions):
+        seeds = rng.randint(2, max_seeds + 1)
+        pits = np.bincount(rng.randint(0, 12, seeds), minlength=12)
+        if pits[:6].sum() == 0 or pits[6:].sum() == 0:
+            continue
+        home_1 = rng.randint(0, 48 - seeds + 1)
+        state = list(pits[:6]) + [home_1] + list(pits[6:]) + \
+            [48 - seeds - home_1, rng.randint(1, 3)]
+        board = Board.from_state([int(x) for x in state])
+        home, other_home = (6, 13) if board.is_player_1s_turn else (13, 6)
+        margin = solve(board) + state[home] - state[other_home]
+        expected = (margin > 0) - (margin < 0)
+        result, move = tablebase.probe(board)
+        if expected != result or move not in board.get_legal_moves():
+            raise AssertionError("Tablebase result %d, search %d for %s"
+                                 % (result, expected, state))
+    logger.info("Checked %d positions against a full search" % positions)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--max_seeds", type=int, default=12,
+                        help="Solve positions with up to this many marbles "
+                             "left in play, at most %d" % MAX_SEEDS)
+    parser.add_argument("--output", default=DEFAULT_PATH,
+                        help="File to write the tablebase to")
+    parser.add_argument("--check", type=int, default=200,
+                        help="Nbr of positions to check with a full search")
+    args = parser.parse_args()
+
+    start = time.time()
+    tb_values, tb_moves = build_tablebase(args.max_seeds)
+    write_tablebase(args.output, args.max_seeds, tb_values, tb_moves)
+    logger.info("Solved %d positions in %.1f sec, wrote %s (%d bytes)"
+                % (len(tb_values), time.time() - start, args.output,
+                   os.path.getsize(args.output)))
+    check_tablebase(Tablebase(args.output), args.check)
@@ -1,19 +1,20 @@
-import datetime
 import logging
 import os
-import pickle
-from random import shuffle
+import time
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.optim as optim
-from torch.utils.data import DataLoader
-from tqdm import tqdm
 
 from NeuralNet import BoardData
-from MonteCarlo import load_pickle, save_as_pickle, board_to_tensor
+from MonteCarlo import load_pickle
+from Checkpoint import CheckpointWriter, load_checkpoint, pickle_save, \
+    rng_state, set_rng_state
 from NeuralNet import AlphaLoss
+from LazyImport import tqdm
+from Reporter import plot_losses
+from ReplayStorage import convert_pickle_dataset, dataset_directory, \
+    list_shards, load_dataset
 
 logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
@@ -21,15 +22,35 @@ logger = logging.getLogger(__file__)
 MODEL_DATA = "./model_data/"
 
 
-def train_net(net, iter, lr, bs, epochs):
-    data_path = "./datasets/iter_%d/" % iter
-    datasets = []
-    for idx, file in enumerate(os.listdir(data_path)):
-        filename = os.path.join(data_path, file)
-        with open(filename, 'rb') as fo:
-            datasets.extend(pickle.load(fo, encoding='bytes'))
-    datasets = np.array(datasets)
-    logger.info("Loaded data from %s." % data_path)
+def checkpoint_path(iteration):
+    """ Training checkpoint of iteration, named after the net it makes """
+    return os.path.join(MODEL_DATA, "trn_net_iter%d.pth.tar" % (iteration + 1))
+
+
+def train_net(net, iter, lr, bs, epochs, replay=None, recency=1.0,
+              resume=False, writer=None):
+    """ Train on the games of iteration iter, or with a ReplayBuffer on
+        every position it holds once those games are added. A recency
+        below 1 samples as many positions, favouring the newer ones.
+
+    With resume, training continues from the checkpoint of iter with its
+    weights, optimizer, scheduler, losses and random states. Checkpoints
+    are written by writer, a CheckpointWriter, or one of its own. """
+    data_path = dataset_directory(iter)
+    if not list_shards(data_path):
+        # Games saved as one pickle each before the sharded format
+        convert_pickle_dataset(data_path)
+    if replay is None:
+        datasets = load_dataset(data_path)
+    else:
+        replay.load_iterations([iter])
+        # Seeded with the iteration so a resumed run draws the same sample
+        datasets = replay.dataset() if recency == 1.0 \
+            else replay.sample(len(replay), recency,
+                               np.random.RandomState(iter))
+    logger.info("Training on %d positions from %s."
+                % (len(datasets[0]), data_path if replay is None else
+                   "iterations %s" % replay.iterations()))
 
     if torch.cuda.is_available():
         net.cuda()
@@ -39,43 +60,59 @@ def train_net(net, iter, lr, bs, epochs):
     scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=
                                     [50, 100, 150, 200, 250, 300, 400],
                                                gamma=0.77)
-    train(net, datasets, optimizer, scheduler, iter, bs, epochs)
-
 
-def train(net, dataset, optim, scheduler, iter, bs, epochs):
+    checkpoint = load_checkpoint(checkpoint_path(iter)) if resume else None
+    if checkpoint is None:
+        train(net, datasets, optimizer, scheduler, iter, bs, epochs,
+              writer=writer)
+        return
+    net.load_state_dict(checkpoint["state_dict"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    scheduler.load_state_dict(checkpoint["scheduler"])
+    logger.info("Resuming iteration %d after epoch %d"
+                % (iter, checkpoint["epoch"]))
+    train(net, datasets, optimizer, scheduler, iter, bs, epochs,
+          checkpoint["epoch"], checkpoint.get("losses"),
+          checkpoint.get("rng"), writer)
+
+
+def train(net, dataset, optim, scheduler, iter, bs, epochs, start_epoch=0,
+          losses_per_epoch=None, rng=None, writer=None):
+    """ Train for the epochs from start_epoch on. A checkpoint is saved
+        every other epoch and after the last, in the background """
     torch.manual_seed(0)
+    if rng is not None:
+        set_rng_state(rng)
+    own_writer = writer is None
+    if own_writer:
+        writer = CheckpointWriter()
     net.train()
     loss_function = AlphaLoss()
 
+    # Build the tensors once, every epoch only shuffles indexes into them
+    device = next(net.parameters()).device
     train_set = BoardData(dataset)
-    train_loader = DataLoader(train_set, batch_size=bs, shuffle=True,
-                              num_workers=0, pin_memory=False)
-    losses_per_epoch = load_results(iter + 1)
+    boards_t, policies_t, values_t = train_set.tensors(device)
+    if losses_per_epoch is None:
+        losses_per_epoch = load_results(iter + 1)
 
     logger.info("Starting training process...")
-    update_size = len(train_loader) // 10
+    num_batches = (len(train_set) + bs - 1) // bs
+    update_size = max(num_batches // 10, 1)
 
-    for epoch in tqdm(range(epochs)):
+    for epoch in tqdm(range(start_epoch, epochs)):
         total_loss = 0.0
         batch_loss = []
+        start_time = time.time()
 
-        shuffle(dataset)
-        for i, data in enumerate(dataset, 1):
-            value = data[2]
-            policy_tar = data[1]
-            board_tar = board_to_tensor(data[0])
-
-            policy_pred, value_pred = net(board_tar)
-            policy_t = torch.tensor(policy_tar, dtype=torch.float32)
-            value_t = torch.tensor(value, dtype=torch.float32)
+        permutation = torch.randperm(len(train_set), device=device)
+        for i, start in enumerate(range(0, len(train_set), bs), 1):
+            batch = permutation[start:start + bs]
+            policy_pred, value_pred = net(boards_t[batch])
 
-            # Set cuda on if using a gpu to avoid ASSERT FAILED error.
-            if torch.cuda.is_available():
-                value_t = value_t.cuda()
-                policy_t = policy_t.cuda()
-
-            # Calculate loss. sub array may fail
-            loss = loss_function(value_pred[:, 0], value_t, policy_pred, policy_t)
+            # Calculate loss over the whole mini batch
+            loss = loss_function(value_pred[:, 0], values_t[batch],
+                                 policy_pred, policies_t[batch])
 
             optim.zero_grad()
             loss.backward()
@@ -84,7 +121,7 @@ def train(net, dataset, optim, scheduler, iter, bs, epochs):
 
             total_loss += loss.item()
 
-            if i % update_size == (update_size - 1):
+            if i % update_size == 0:
                 batch_loss.append(1 * total_loss / update_size)
                 logger.debug(f"Iteration: {iter}, Epoch: {epoch + 1}.")
                 logger.debug(f"Loss per batch: {batch_loss[-1]}")
@@ -92,34 +129,50 @@ def train(net, dataset, optim, scheduler, iter, bs, epochs):
                 total_loss = 0.0
         # End of for loop
 
+        logger.info("Epoch %d: %.0f samples/sec"
+                    % (epoch + 1,
+                       len(train_set) / (time.time() - start_time)))
         scheduler.step()
         if len(batch_loss) >= 1:
             losses_per_epoch.append(sum(batch_loss) / len(batch_loss))
-        if (epoch % 2) == 0:
+        if (epoch % 2) == 0 or epoch + 1 == epochs:
             filename = "losses_per_epoch_iter%d.pkl" % (iter + 1)
             complete_name = os.path.join(MODEL_DATA, filename)
-            save_as_pickle(complete_name, losses_per_epoch)
-            torch.save({'epoch': epoch + 1,
-                        'state_dict': net.state_dict(),
-                        'optimizer': optim.state_dict(),
-                        'scheduler': scheduler.state_dict(), },
-                       os.path.join(MODEL_DATA,
-                                    "trn_net_iter%d.pth.tar" %
-                                    (iter + 1)))
+            writer.save(losses_per_epoch, complete_name, pickle_save)
+            writer.save({'epoch': epoch + 1,
+                         'state_dict': net.state_dict(),
+                         'optimizer': optim.state_dict(),
+                         'scheduler': scheduler.state_dict(),
+                         'losses': losses_per_epoch,
+                         'rng': rng_state()},
+                        checkpoint_path(iter))
+    if own_writer:
+        writer.close()
     logger.info("Finished Training!")
-    fig = plt.figure()
-    ax = fig.add_subplot(222)
-    ax.scatter([e for e in range(len(losses_per_epoch))],
-               losses_per_epoch)
-    ax.set_xlabel("Epoch")
-    ax.set_ylabel("Loss per batch")
-    ax.set_title("Loss vs Epoch")
-    plt.savefig(os.path.join(MODEL_DATA,
-                             "Loss_vs_Epoch_iter%d_%s.png" % (
-                             (iter + 1),
-                             datetime.datetime.today().strftime(
-                                 "%Y-%m-%d"))))
-    plt.show()
+    plot_losses(losses_per_epoch, iter + 1, MODEL_DATA)
+
+
+def train_steps(net, dataset, optim, bs, steps):
+    """ Train on steps mini batches drawn at random from dataset and
+        return the mean loss. Used by the pipeline learner, which keeps
+        its optimizer between calls """
+    net.train()
+    loss_function = AlphaLoss()
+    device = next(net.parameters()).device
+    boards_t, policies_t, values_t = BoardData(dataset).tensors(device)
+
+    total_loss = 0.0
+    for _ in range(steps):
+        batch = torch.randint(len(boards_t), (bs,), device=device)
+        policy_pred, value_pred = net(boards_t[batch])
+        loss = loss_function(value_pred[:, 0], values_t[batch],
+                             policy_pred, policies_t[batch])
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+        total_loss += loss.item()
+    net.eval()
+    return total_loss / max(steps, 1)
 
 
 def load_results(iteration):
@@ -0,0 +1,128 @@
+import numpy as np
+
+from rules.Mancala import Board, SOWING_TABLE, TOTAL_MARBLES
+
+
+def build_sowing_arrays():
+    """ Dense copies of SOWING_TABLE indexed by [player - 1, pit, marbles]
+        giving the per-pit increments and the landing pit of a move. """
+    increments = np.zeros((2, 14, TOTAL_MARBLES + 1, 14), dtype=np.int16)
+    landing = np.zeros((2, 14, TOTAL_MARBLES + 1), dtype=np.int64)
+    for player in (1, 2):
+        for pit, entries in enumerate(SOWING_TABLE[player]):
+            if entries is None:
+                continue
+            for marbles in range(1, TOTAL_MARBLES + 1):
+                last_pit, pit_increments, _, _ = entries[marbles]
+                landing[player - 1, pit, marbles] = last_pit
+                for pit_to_add, amount in pit_increments:
+                    increments[player - 1, pit, marbles, pit_to_add] = amount
+    return increments, landing
+
+
+SOWING_INCREMENTS, SOWING_LANDING = build_sowing_arrays()
+
+# Opposite pit of every pit, homes map onto themselves and are never used
+OPPOSITE_PIT = np.array([12, 11, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0, 13])
+
+# Pits each player may pick marbles up from, indexed by player - 1
+SIDE_MASK = np.zeros((2, 14), dtype=bool)
+SIDE_MASK[0, :6] = True
+SIDE_MASK[1, 7:13] = True
+
+
+class BatchBoard(object):
+    """ Steps many independent games of Mancala at once.
+
+    Every row of boards has the same layout as Board.current_board, so
+    index 14 holds the player to move. All methods follow the rules of
+    Board exactly: illegal moves and moves in finished games leave that
+    game untouched. """
+
+    def __init__(self, num_games):
+        self.boards = np.tile(np.array(Board.initial_board(),
+                                       dtype=np.int16), (num_games, 1))
+        self.game_over = np.zeros(num_games, dtype=bool)
+
+    def __len__(self):
+        return len(self.boards)
+
+    @classmethod
+    def from_boards(cls, boards):
+        batch = cls(len(boards))
+        for idx, board in enumerate(boards):
+            batch.boards[idx] = board.current_board
+            batch.game_over[idx] = board.game_over
+        return batch
+
+    def board(self, idx):
+        """ Return game idx as a regular Board """
+        return Board.from_state(self.boards[idx].tolist(),
+                                bool(self.game_over[idx]))
+
+    def legal_moves_mask(self):
+        """ (N, 14) bool array of the pits each game may play """
+        mask = SIDE_MASK[self.boards[:, 14] - 1] & (self.boards[:, :14] > 0)
+        mask[self.game_over] = False
+        return mask
+
+    def random_moves(self, rng=np.random):
+        """ One uniformly random legal move per game, 0 if there is none """
+        scores = rng.random((len(self.boards), 14)) * \
+            self.legal_moves_mask()
+        return scores.argmax(axis=1)
+
+    def process_moves(self, moves):
+        boards = self.boards
+        moves = np.asarray(moves, dtype=np.int64)
+        rows = np.arange(len(boards))
+        # Moves off the board are illegal like any other
+        in_range = (moves >= 0) & (moves < 14)
+        legal = in_range & self.legal_moves_mask()[
+            rows, np.where(in_range, moves, 0)]
+        rows, moves = rows[legal], moves[legal]
+        if len(rows) == 0:
+            return
+        player = boards[rows, 14] - 1
+
+        # Pick up the marbles and sow them in one step
+        marbles = boards[rows, moves]
+        boards[rows, moves] = 0
+        boards[rows, :14] += SOWING_INCREMENTS[player, moves, marbles]
+        landing = SOWING_LANDING[player, moves, marbles]
+
+        # Steal when the last marble landed in an empty pit on your side
+        opposite = OPPOSITE_PIT[landing]
+        steal = SIDE_MASK[player, landing] & \
+            (boards[rows, landing] == 1) & (boards[rows, opposite] > 0)
+        steal_rows = rows[steal]
+        stolen = boards[steal_rows, opposite[steal]] + 1
+        boards[steal_rows, landing[steal]] = 0
+        boards[steal_rows, opposite[steal]] = 0
+        boards[steal_rows, np.where(player[steal] == 0, 6, 13)] += stolen
+
+        # Ending in your own home gives a free turn
+        own_home = np.where(player == 0, 6, 13)
+        switch_player = landing != own_home
+
+        # Check for the win conditions and collect the leftover marbles
+        side_1 = boards[rows, :6].sum(axis=1)
+        side_2 = boards[rows, 7:13].sum(axis=1)
+        over = (boards[rows, 6] > 24) | (boards[rows, 13] > 24) | \
+            (side_1 == 0) | (side_2 == 0)
+        over_rows = rows[over]
+        boards[over_rows, 6] += side_1[over]
+        boards[over_rows, 13] += side_2[over]
+        boards[over_rows, :6] = 0
+        boards[over_rows, 7:13] = 0
+        self.game_over[over_rows] = True
+
+        switch_rows = rows[switch_player & ~over]
+        boards[switch_rows, 14] = 3 - boards[switch_rows, 14]
+
+    def is_game_over(self):
+        return self.game_over.copy()
+
+    def winner(self):
+        """ 1 if player 1 is ahead, -1 if player 2 is, 0 for a tie """
+        return np.sign(self.boards[:, 6] - self.boards[:, 13])
@@ -1,20 +1,238 @@
+import random
+
+TOTAL_MARBLES = 48
+
+
+def build_sowing_table():
+    """ Precompute where the marbles of every possible move end up.
+
+    The pits a move sows into only depend on the player, the starting
+    pit and the number of marbles picked up, so
+    table[player][pit][marbles] holds a tuple of
+    (landing pit, ((pit, marbles added), ...), added to player 1's side,
+    added to player 2's side). Unused entries are None. """
+    table = [None, [None] * 14, [None] * 14]
+    for player in (1, 2):
+        enemy_home = 13 if player == 1 else 6
+        own_side = range(6) if player == 1 else range(7, 13)
+        for start in own_side:
+            entries = [None]
+            for marbles in range(1, TOTAL_MARBLES + 1):
+                counts = [0] * 14
+                pit = start
+                for _ in range(marbles):
+                    pit = (pit + 1) % 14
+                    if pit == enemy_home:
+                        pit = (pit + 1) % 14
+                    counts[pit] += 1
+                increments = tuple((p, c) for p, c in enumerate(counts)
+                                   if c)
+                entries.append((pit, increments, sum(counts[:6]),
+                                sum(counts[7:13])))
+            table[player][start] = entries
+    return table
+
+
+SOWING_TABLE = build_sowing_table()
+
+# Bit of each pit a move can be played from in Board.occupied, the homes
+# have none
+PIT_BITS = [0 if pit in (6, 13) else 1 << pit for pit in range(14)]
+
+# Shift that brings the six pits of a player down to bits 0-5
+SIDE_SHIFT = [None, 0, 7]
+
+
+def build_sown_masks():
+    """ PIT_BITS of the pits each SOWING_TABLE entry adds marbles to,
+        indexed the same way """
+    masks = [None, [None] * 14, [None] * 14]
+    for player in (1, 2):
+        for pit, entries in enumerate(SOWING_TABLE[player]):
+            if entries is None:
+                continue
+            masks[player][pit] = [None] + [
+                sum(PIT_BITS[p] for p, _ in entry[1])
+                for entry in entries[1:]]
+    return masks
+
+
+SOWN_MASKS = build_sown_masks()
+
+
+def build_legal_moves():
+    """ table[player][mask] is the tuple of moves of player when the six
+        bits of mask tell which of their pits hold marbles """
+    return [None] + [
+        [tuple(SIDE_SHIFT[player] + bit for bit in range(6)
+               if mask >> bit & 1) for mask in range(64)]
+        for player in (1, 2)]
+
+
+LEGAL_MOVES = build_legal_moves()
+
+
+def occupied_mask(board):
+    """ Board.occupied of a board list from scratch """
+    mask = 0
+    for pit in range(14):
+        if board[pit]:
+            mask |= PIT_BITS[pit]
+    return mask
+
+
+def build_zobrist_keys(seed=20190601):
+    """ Random 64 bit keys for every (pit, marble count) pair plus one for
+        player 2 to move, used to hash positions incrementally """
+    rng = random.Random(seed)
+    pit_keys = [[rng.getrandbits(64) for _ in range(TOTAL_MARBLES + 1)]
+                for _ in range(14)]
+    return pit_keys, rng.getrandbits(64)
+
+
+ZOBRIST_PITS, ZOBRIST_PLAYER_2 = build_zobrist_keys()
+
+# Pit i of a board seen from the other player's side. Swapping the two
+# halves is its own inverse, so the same list maps canonical moves and
+# policies back to the board.
+MIRROR_PITS = [(pit + 7) % 14 for pit in range(14)]
+
+# Keys of each pit once the board is mirrored
+ZOBRIST_MIRROR = [ZOBRIST_PITS[MIRROR_PITS[pit]] for pit in range(14)]
+
+
+def zobrist_hash(board):
+    """ Hash of a board list from scratch, see Board.zobrist """
+    key = ZOBRIST_PLAYER_2 if board[14] == 2 else 0
+    for pit in range(14):
+        key ^= ZOBRIST_PITS[pit][board[pit]]
+    return key
+
+
+def mirror_zobrist_hash(board):
+    """ Hash of the mirrored pits of a board list, see Board.zobrist """
+    key = 0
+    for pit in range(14):
+        key ^= ZOBRIST_MIRROR[pit][board[pit]]
+    return key
+
+
+def canonical_board(board):
+    """ The board seen by the player to move.
+
+    For player 2 the halves are swapped so that the player to move always
+    owns pits 0-6 and index 14 is always 1. Policies over canonical moves
+    are mapped back with policy[MIRROR_PITS] and values change sign. """
+    if board[14] == 1:
+        return board[:]
+    return board[7:14] + board[:7] + [1]
+
+
+def canonical_move(move, player):
+    return move if player == 1 else MIRROR_PITS[move]
+
+
 class Board(object):
+    # Only the pits and a few flags live on the instance so that cloning a
+    # board during search copies 15 small integers instead of a whole
+    # object graph. Whose turn it is comes from index 14 of the board.
+    __slots__ = ('current_board', 'game_over', 'winner',
+                 'is_printing', 'is_debug_printing',
+                 'side_1_total', 'side_2_total', 'zobrist',
+                 'mirror_zobrist', 'occupied')
+
+    player_1_pit = 6
+    player_2_pit = 13
+    pairs = {0: 12, 1: 11, 2: 10,  3: 9,  4: 8,  5: 7,
+             7:  5, 8:  4, 9:  3, 10: 2, 11: 1, 12: 0}
+
     def __init__(self):
-        self.is_player_1s_turn = True
-        self.player = 1
         self.current_board = self.initial_board()
-        self.player_1_pit = 6
-        self.player_2_pit = 13
+        # Running count of the marbles in each player's six pits
+        self.side_1_total = 24
+        self.side_2_total = 24
+        # 64 bit hash of the pits and the side to move, kept up to date
+        # as moves are made so search can use it as a table key. The
+        # hash of the mirrored pits gives canonical_zobrist.
+        self.zobrist = zobrist_hash(self.current_board)
+        self.mirror_zobrist = mirror_zobrist_hash(self.current_board)
+        # PIT_BITS of the pits holding marbles, legal_mask reads the moves
+        # of the player to move from it
+        self.occupied = occupied_mask(self.current_board)
         self.game_over = False
         self.winner = None
         self.is_printing = False
         self.is_debug_printing = False
-        self.pairs = {0: 12, 1: 11, 2: 10,  3: 9,  4: 8,  5: 7,
-                      7:  5, 8:  4, 9:  3, 10: 2, 11: 1, 12: 0}
 
     def __str__(self):
         return "Board object for game Mancala"
 
+    def __deepcopy__(self, memo):
+        return self.clone()
+
+    def clone(self):
+        """ Cheap copy of the board used by the tree searches """
+        board = Board.__new__(Board)
+        board.current_board = self.current_board[:]
+        board.game_over = self.game_over
+        board.winner = self.winner
+        board.is_printing = self.is_printing
+        board.is_debug_printing = self.is_debug_printing
+        board.side_1_total = self.side_1_total
+        board.side_2_total = self.side_2_total
+        board.zobrist = self.zobrist
+        board.mirror_zobrist = self.mirror_zobrist
+        board.occupied = self.occupied
+        return board
+
+    @classmethod
+    def from_state(cls, state, game_over=False, hashes=None):
+        """ Build a board from a 15 entry list laid out like
+            current_board. hashes are its (zobrist, mirror_zobrist) when
+            the caller has them already """
+        board = cls.__new__(cls)
+        board.current_board = list(state)
+        board.winner = None
+        board.is_printing = False
+        board.is_debug_printing = False
+        board.side_1_total = sum(board.current_board[:6])
+        board.side_2_total = sum(board.current_board[7:13])
+        if hashes is None:
+            hashes = (zobrist_hash(board.current_board),
+                      mirror_zobrist_hash(board.current_board))
+        board.zobrist, board.mirror_zobrist = hashes
+        board.occupied = occupied_mask(board.current_board)
+        board.game_over = game_over
+        return board
+
+    @property
+    def is_player_1s_turn(self):
+        return self.current_board[14] == 1
+
+    @property
+    def player(self):
+        return self.current_board[14]
+
+    @property
+    def legal_mask(self):
+        """ Six bits, bit i set when the i-th pit of the player to move
+            holds marbles """
+        return self.occupied >> SIDE_SHIFT[self.current_board[14]] & 63
+
+    @property
+    def legal_moves(self):
+        """ Tuple of the legal moves, shared by every board with the same
+            legal_mask """
+        player = self.current_board[14]
+        return LEGAL_MOVES[player][self.occupied >> SIDE_SHIFT[player] & 63]
+
+    @property
+    def canonical_zobrist(self):
+        """ Hash of canonical_board(current_board), shared by a position
+            and its mirror image with the other player to move """
+        return self.zobrist if self.current_board[14] == 1 \
+            else self.mirror_zobrist
+
     @staticmethod
     def initial_board():
         # Returns a representation of the starting state of the game
@@ -31,27 +249,45 @@ class Board(object):
         if self.is_printing:
             print("Processing move {} for player {}"
                   .format(move, self.player))
-        if move not in self.get_legal_moves():
+        if move not in self.legal_moves:
             # legal moves is the values of the moves not the indexes
             print("Not a valid move.")
             return
 
         # Get the marbles from the hole.
-        marbles = self.current_board[move]
-        self.current_board[move] = 0
+        board = self.current_board
+        marbles = board[move]
+        board[move] = 0
+        zobrist = self.zobrist ^ ZOBRIST_PITS[move][marbles] ^ \
+            ZOBRIST_PITS[move][0]
+        mirror = self.mirror_zobrist ^ ZOBRIST_MIRROR[move][marbles] ^ \
+            ZOBRIST_MIRROR[move][0]
         if self.is_debug_printing:
             print("Marbles in pit {} is {}".format(move, marbles))
 
         # Place the marbles around the board. Skipping opponent home
-        pit_to_add = move
+        pit_to_add, increments, side_1_added, side_2_added = \
+            SOWING_TABLE[board[14]][move][marbles]
+        self.occupied = self.occupied & ~PIT_BITS[move] | \
+            SOWN_MASKS[board[14]][move][marbles]
+        for pit, amount in increments:
+            before = board[pit]
+            after = before + amount
+            board[pit] = after
+            keys = ZOBRIST_PITS[pit]
+            zobrist ^= keys[before] ^ keys[after]
+            keys = ZOBRIST_MIRROR[pit]
+            mirror ^= keys[before] ^ keys[after]
+        self.zobrist = zobrist
+        self.mirror_zobrist = mirror
+        if self.is_player_1s_turn:
+            self.side_1_total += side_1_added - marbles
+            self.side_2_total += side_2_added
+        else:
+            self.side_1_total += side_1_added
+            self.side_2_total += side_2_added - marbles
         if self.is_debug_printing:
-            print("pit to add {}".format(pit_to_add))
-        for _ in range(marbles):
-            pit_to_add = self.get_pit_to_add(pit_to_add)
-            if self.is_debug_printing:
-                print("in for loop for placing marbles. Adding to {}"
-                      .format(pit_to_add))
-            self.current_board[pit_to_add] += 1  # add 1 marble to pit
+            print("Last marble placed in pit {}".format(pit_to_add))
 
         # Check if pit was empty, steal from opponent only on your side
         if self.current_board[pit_to_add] == 1 \
@@ -75,7 +311,8 @@ class Board(object):
 
     @staticmethod
     def policy_for_legal_moves(legal_moves, policy):
-        policy = [policy[index] for index in legal_moves]
+        # Work in python floats, float32 sums are too coarse for numpy
+        policy = [float(policy[index]) for index in legal_moves]
 
         # Normalize the policy to solve known issue with numpy
         policy_sum = sum(policy)
@@ -93,26 +330,11 @@ class Board(object):
         return p_dict
 
     def get_legal_moves(self):
-        filtered = list(map(lambda x: x[0],
-                            filter(lambda x: x[1] != 0,
-                                   enumerate(self.current_board))))
-
-        # Remove player homes from legal moves
-        if self.player_1_pit in filtered:
-            filtered.remove(self.player_1_pit)
-        if self.player_2_pit in filtered:
-            filtered.remove(self.player_2_pit)
-
-        board_side = list(filter(lambda x: x < 6, filtered)) \
-            if self.is_player_1s_turn \
-            else list(filter(lambda x: 6 < x < 14, filtered))
-
-        return board_side
+        return list(self.legal_moves)
 
     def switch_player(self):
-        self.is_player_1s_turn = not self.is_player_1s_turn
-        self.player = 1 if self.is_player_1s_turn else 2
-        self.current_board[14] = self.player
+        self.current_board[14] = 2 if self.is_player_1s_turn else 1
+        self.zobrist ^= ZOBRIST_PLAYER_2
 
     def get_whose_turn(self):
         return 1 if self.is_player_1s_turn else 2
@@ -172,15 +394,7 @@ class Board(object):
         return self.game_over
 
     def marbles_gone_on_one_side(self):
-        side1 = self.current_board[:6]
-        if len(list(filter(lambda x: x == 0, side1))) == 6:
-            return True
-
-        side2 = self.current_board[7:13]
-        if len(list(filter(lambda x: x == 0, side2))) == 6:
-            return True
-
-        return False
+        return self.side_1_total == 0 or self.side_2_total == 0
 
     def print_current_board(self):
         print("\n\nPlayer {}'s turn".format(self.current_board[14]))
@@ -263,6 +477,11 @@ class Board(object):
             self.current_board[13] += to_add
         if self.is_debug_printing:
             print("Total after {}".format(self.current_board[13]))
+        self.side_1_total = 0
+        self.side_2_total = 0
+        self.occupied = 0
+        self.zobrist = zobrist_hash(self.current_board)
+        self.mirror_zobrist = mirror_zobrist_hash(self.current_board)
 
     def get_opposite_pit(self, pit):
         return self.pairs.get(pit)
@@ -279,6 +498,14 @@ class Board(object):
         if opponent_amount == 0:
             return
 
+        own_home = self.player_1_pit if self.is_player_1s_turn \
+            else self.player_2_pit
+        changed_pits = (pit_to_add, opponent_pit, own_home)
+        for pit in changed_pits:
+            self.zobrist ^= ZOBRIST_PITS[pit][self.current_board[pit]]
+            self.mirror_zobrist ^= \
+                ZOBRIST_MIRROR[pit][self.current_board[pit]]
+
         amount_to_add = 1
         self.current_board[pit_to_add] = 0
         amount_to_add += self.current_board[opponent_pit]
@@ -287,8 +514,18 @@ class Board(object):
             print("Stole {} marbles from your opponent!"
                   .format(self.current_board[opponent_pit]))
         self.current_board[opponent_pit] = 0
+        self.occupied &= ~(PIT_BITS[pit_to_add] | PIT_BITS[opponent_pit])
 
         # Add stolen marbles to current player's pit
-        own_home = self.player_1_pit if self.is_player_1s_turn \
-            else self.player_2_pit
-        self.current_board[own_home] += amount_to_add
+        if self.is_player_1s_turn:
+            self.current_board[self.player_1_pit] += amount_to_add
+            self.side_1_total -= 1
+            self.side_2_total -= amount_to_add - 1
+        else:
+            self.current_board[self.player_2_pit] += amount_to_add
+            self.side_2_total -= 1
+            self.side_1_total -= amount_to_add - 1
+        for pit in changed_pits:
+            self.zobrist ^= ZOBRIST_PITS[pit][self.current_board[pit]]
+            self.mirror_zobrist ^= \
+                ZOBRIST_MIRROR[pit][self.current_board[pit]]